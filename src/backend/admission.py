@@ -0,0 +1,74 @@
+'''
+Admission control of expensive queries.
+
+Before evaluating a query, `utils.estimate_cost` predicts the number of
+results and the work (docs read and written by the bitmap operations) from
+the cardinalities of the postings lists, and the query is rejected if the
+work is more than `MAX_QUERY_WORK` times the number of docs, e.g. a long OR
+of NOTs.
+
+After evaluating it, `sort_mode` decides how to page the results, by their
+actual number:
+
+- "count_only": more than `COUNT_ONLY_SIZE` results, only the total is
+  returned, no docs.
+- "capped_sort": more than `MAX_SORT_SIZE` results, only the requested page
+  is selected with a heap instead of sorting all results.
+- "full": otherwise.
+
+The limits are set with environment variables of the same names. The number
+of concurrent requests of each client is limited by `ClientLimiter`, with
+`MAX_CONCURRENT_PER_CLIENT`. With the pre-fork server, each worker has its
+own limiter.
+'''
+import os
+import threading
+
+MAX_QUERY_WORK = float(os.environ.get('MAX_QUERY_WORK', '20'))
+MAX_SORT_SIZE = int(os.environ.get('MAX_SORT_SIZE', '100000'))
+COUNT_ONLY_SIZE = int(os.environ.get('COUNT_ONLY_SIZE', '5000000'))
+MAX_CONCURRENT_PER_CLIENT = int(
+    os.environ.get('MAX_CONCURRENT_PER_CLIENT', '4'))
+
+COUNT_ONLY = 'count_only'
+CAPPED_SORT = 'capped_sort'
+FULL = 'full'
+
+
+def admit(work: float, num_docs: int) -> bool:
+    '''Whether to evaluate a query of the estimated `work`'''
+    return work <= MAX_QUERY_WORK * num_docs
+
+
+def sort_mode(size: int) -> str:
+    '''How to sort and page `size` results'''
+    if size > COUNT_ONLY_SIZE:
+        return COUNT_ONLY
+    if size > MAX_SORT_SIZE:
+        return CAPPED_SORT
+    return FULL
+
+
+class ClientLimiter:
+    '''Limit the number of concurrent requests of each client'''
+    def __init__(self, max_concurrent: int=MAX_CONCURRENT_PER_CLIENT):
+        self.max_concurrent = max_concurrent
+        self.active = {}   # {client: number of running requests}
+        self.lock = threading.Lock()
+
+    def acquire(self, client: str) -> bool:
+        '''Return False if the client already has too many requests'''
+        with self.lock:
+            cnt = self.active.get(client, 0)
+            if cnt >= self.max_concurrent:
+                return False
+            self.active[client] = cnt + 1
+            return True
+
+    def release(self, client: str) -> None:
+        with self.lock:
+            cnt = self.active[client] - 1
+            if cnt == 0:
+                del self.active[client]
+            else:
+                self.active[client] = cnt
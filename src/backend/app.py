@@ -1,11 +1,25 @@
+import io
+import os
+import csv
+import json
 import time
+from functools import wraps
 import pickle as pkl
+import numpy as np
 from pyroaring import BitMap
-from flask import Flask, render_template, g, request, url_for, jsonify
+from flask import Flask, render_template, request, url_for, jsonify, Response
 from flask_cors import CORS, cross_origin
 from elasticsearch import Elasticsearch
 
 import utils
+import metrics
+import admission
+import startup
+import dates
+from postings import PostingsIndex, MmapPostings
+from term_dict import TermDict
+from segmenter import Segmenter
+from snippets import SnippetStore
 
 app = Flask(__name__)
 CORS(app, support_credentials=True)
@@ -13,52 +27,343 @@ CORS(app, support_credentials=True)
 es_index = 'rmrb_00-15'
 es_index_date = 'rmrb_00-15-date'
 file_inv_idx = '../../data/inv_idx_roaring.pkl'
-id_to_date: [int] = []   # Store a map from doc id to date for faster date lookup
-NUM_DOCS = None
-
-
-def get_inv_idx():
-    '''Load inverted index, add it to g if not added'''
-    if 'inv_idx' not in g:
-        print('Loading inverted index...')
-        with open(file_inv_idx, 'rb') as f:
-            g.inv_idx = pkl.load(f)
-    return g.inv_idx
-
-
-def get_id_to_date():
-    '''Get all dates in the index'''
-    if 'dates' not in g:
-        print('Loading dates...')
-        FILE_ID_TO_DATE = '../../data/id_to_date.txt'
-        id_to_date = {}
-        with open(FILE_ID_TO_DATE, 'r') as f:
-            for line in f:
-                line = line.strip().split('\t')
-                id_to_date[int(line[0])] = line[1]
-        g.id_to_date = id_to_date
-        print(f'Got {len(g.id_to_date)} dates')
-    return g.id_to_date
+file_inv_idx_mmap = '../../data/inv_idx_roaring.bin'
+file_inv_idx_packed = '../../data/inv_idx_packed.pkl'
+# "mmap" (default, loads instantly, falls back to "roaring" if there is no
+# `inv_idx_roaring.bin`), "roaring" or "packed" (smaller, with a codec per
+# term, see `postings.py`)
+INV_IDX_FORMAT = os.environ.get('INV_IDX_FORMAT', 'mmap')
+file_corpus_stats = '../../data/corpus_stats.npz'
+file_meta_idx = '../../data/meta_idx_roaring.pkl'
+file_vocab = '../../data/vocab.txt'
+file_token_freq = '../../data/token_freq.pkl'
+file_id_to_date = '../../data/id_to_date.npy'
+file_id_to_date_txt = '../../data/id_to_date.txt'
+file_sim_docs = '../../data/similar_docs.npy'
+dir_token_store = '../../data/token_store'
+file_dup_clusters = '../../data/dup_clusters.npy'
+file_canonical_docs = '../../data/canonical_docs.pkl'
+
+
+def load_inv_idx():
+    print(f'Loading inverted index ({INV_IDX_FORMAT})...')
+    if INV_IDX_FORMAT == 'mmap' and os.path.exists(file_inv_idx_mmap):
+        return MmapPostings(file_inv_idx_mmap)
+    if INV_IDX_FORMAT == 'packed':
+        return PostingsIndex.load(file_inv_idx_packed)
+    return load_pickle(file_inv_idx)
+
+
+def load_id_to_date():
+    '''The date column (see `dates.py`), a map from doc id to date'''
+    if os.path.exists(file_id_to_date):
+        return dates.load_dates(file_id_to_date)
+    return dates.load_dates_txt(file_id_to_date_txt)
+
+
+def load_pickle(file: str):
+    with open(file, 'rb') as f:
+        return pkl.load(f)
+
+
+def load_segmenter():
+    corpus_stats = utils.load_corpus_stats(file_corpus_stats)
+    return Segmenter(corpus_stats['doc_freq'])
+
+
+def load_sim_docs():
+    '''Similar docs of each doc, None if only the pickled chunks exist'''
+    if os.path.exists(file_sim_docs):
+        return np.load(file_sim_docs, mmap_mode='r')
+    return None
+
+
+def load_snippet_store():
+    '''The token store for snippets, None if it is not built'''
+    if os.path.exists(dir_token_store):
+        return SnippetStore(dir_token_store)
+    return None
+
+
+def load_dup_clusters():
+    '''
+    The cluster of duplicates of each doc (see `preprocess/dedup.py`), None
+    if it is not built
+    '''
+    if os.path.exists(file_dup_clusters):
+        return np.load(file_dup_clusters, mmap_mode='r')
+    return None
+
+
+def load_canonical_docs():
+    '''Bitmap of the canonical docs of the clusters, None if it is not built'''
+    if os.path.exists(file_canonical_docs):
+        return load_pickle(file_canonical_docs)
+    return None
 
 
 # Initialize global variables
 start_time = time.time()
 print('Initializing global variables...')
-with app.app_context():
-    # 将全局变量加到`g`中。
-    NUM_DOCS = 612031
-    inv_idx = get_inv_idx()
-    id_to_date = get_id_to_date()
+loaded = startup.load_parallel({
+    'inv_idx': (load_inv_idx,),
+    'id_to_date': (load_id_to_date,),
+    # Bitmaps of docs by year, month, day, column and author
+    'meta_idx': (load_pickle, file_meta_idx),
+})
+inv_idx = loaded['inv_idx']
+id_to_date = loaded['id_to_date']
+meta_idx = loaded['meta_idx']
+NUM_DOCS = len(id_to_date)
+# Years, months and days of the metadata index, for paging with cursors
+calendar = utils.build_calendar(meta_idx)
+DEFAULT_PAGE_SIZE = 20
+EXPORT_BATCH_SIZE = 500   # Docs per `mget` of `/export`
+# Fields of `/export` in CSV, the content is joined into text
+EXPORT_CSV_FIELDS = ['id', 'date', 'column', 'author', 'title', 'file_name',
+                     'content']
+# For expanding wildcard and fuzzy terms, and suggesting terms
+term_dict = startup.Lazy(
+    'term_dict', TermDict.from_vocab, file_vocab, 2,
+    file_token_freq if os.path.exists(file_token_freq) else None)
+# For segmenting query terms that are not in the index
+segmenter = startup.Lazy('segmenter', load_segmenter)
+sim_docs = startup.Lazy('sim_docs', load_sim_docs)
+snippet_store = startup.Lazy('snippet_store', load_snippet_store)
+# For collapsing near-duplicate docs
+dup_clusters = startup.Lazy('dup_clusters', load_dup_clusters)
+canonical_docs = startup.Lazy('canonical_docs', load_canonical_docs)
+
+print(startup.report(time.time() - start_time))
+is_warm = False
+limiter = admission.ClientLimiter()
+
+
+def limit_concurrency(func):
+    '''Return an error (429) if the client has too many running requests'''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        client = request.remote_addr
+        if not limiter.acquire(client):
+            metrics.throttled_requests.inc(endpoint=func.__name__)
+            result = {'status': 'error', 'message': 'too many requests'}
+            return jsonify(result), 429
+        try:
+            res = func(*args, **kwargs)
+        except:
+            limiter.release(client)
+            raise
+        if isinstance(res, Response) and res.is_streamed:
+            # Keep the slot until the response is streamed
+            res.response = ReleaseAfter(res.response, client)
+        else:
+            limiter.release(client)
+        return res
+    return wrapper
+
+
+class ReleaseAfter:
+    '''
+    The body of a streamed response, releasing the slot of the client in
+    `limiter` when the server closes it (at the end, or if the client is gone).
+    '''
+    def __init__(self, iterable, client: str):
+        self.iterable = iterable
+        self.client = client
+        self.released = False
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+        if not self.released:
+            self.released = True
+            limiter.release(self.client)
+
+
+def check_cost(node, endpoint: str) -> None:
+    '''
+    Raise `utils.QueryTooExpensive` if the estimated work of the query is over
+    the limit, see `admission.py`.
+    '''
+    size, work = utils.estimate_cost(node, inv_idx, NUM_DOCS, meta_idx,
+                                     term_dict)
+    if not admission.admit(work, NUM_DOCS):
+        metrics.rejected_queries.inc(endpoint=endpoint)
+        raise utils.QueryTooExpensive(size, work)
+
+
+def too_expensive(e: utils.QueryTooExpensive) -> dict:
+    return {
+        'status': 'error',
+        'message': 'query too expensive',
+        'estimate': {'size': int(e.size), 'work': int(e.work)},
+    }
+
+
+def sort_page(postings_list: BitMap, sort_order: str, min_index: int,
+              max_index: int, endpoint: str) -> ([int], str):
+    '''
+    Sort the results by date and return the page [min_index, max_index), and
+    the mode of `admission.sort_mode`: with too many results, only the page
+    is selected, or nothing is returned.
+    '''
+    mode = admission.sort_mode(len(postings_list))
+    if mode == admission.FULL:
+        ids = utils.sort_by_date(postings_list, id_to_date, sort_order)
+        return ids[min_index:max_index], mode
+    metrics.degraded_queries.inc(endpoint=endpoint, mode=mode)
+    if mode == admission.COUNT_ONLY:
+        return [], mode
+    if max_index is None:
+        max_index = min_index + admission.MAX_SORT_SIZE
+    ids = utils.top_by_date(postings_list, id_to_date, max_index, sort_order)
+    return ids[min_index:max_index], mode
 
-elapsed_time = time.time() - start_time
-print('Done initializing global variables.')
-print(f'Elapsed time: {elapsed_time}')
+
+def warm_up(num_terms: int=1000) -> None:
+    '''
+    Page in the postings of the `num_terms` most frequent terms by reading all
+    their containers, evaluate a query once, and load the lazy artifacts and
+    build the fuzzy lookup index of the term dictionary, so that the first
+    requests are not slower. The pre-fork server (`serve.py`) calls this in
+    the master process before forking, the postings loaded here are shared
+    by the workers and the ones they load later are bounded (see
+    `MmapPostings`).
+    '''
+    global is_warm
+    start_time = time.time()
+    if isinstance(inv_idx, MmapPostings):
+        terms = sorted(inv_idx, key=inv_idx.cardinality, reverse=True)
+        hot = [inv_idx[t] for t in terms[:num_terms]]
+    else:
+        hot = sorted(inv_idx.values(), key=len, reverse=True)[:num_terms]
+    cnt = len(BitMap.union(*hot)) if hot else 0
+    utils.process_boolean_query('not (a or b) and c', inv_idx, NUM_DOCS)
+    segmenter.get()
+    sim_docs.get()
+    snippet_store.get()
+    dup_clusters.get()
+    canonical_docs.get()
+    term_dict.build_deletes()
+    if isinstance(inv_idx, MmapPostings):
+        inv_idx.freeze()
+    is_warm = True
+    print(f'Warmed up {len(hot)} postings lists ({cnt} docs) in '
+          f'{time.time() - start_time:.2f}s')
+
+
+def parse_page_size(value: str) -> int:
+    '''`page_size` of a request, raise ValueError if it is not a positive int'''
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    page_size = int(value)
+    if page_size < 1:
+        raise ValueError(f'Invalid page_size: {value}')
+    return page_size
+
+
+def cursor_page(postings_list: BitMap, cursor: str, page_size: int,
+                sort_order: str) -> ([int], str):
+    '''
+    The page of results after the doc of `cursor` ("" for the first page), by
+    `utils.page_by_date`, and the cursor of the next page (None after the last
+    page). Raise ValueError if the cursor is invalid.
+    '''
+    after = None
+    if cursor:
+        days, doc_id = utils.decode_cursor(cursor)
+        after = (dates.days_to_date(days), doc_id)
+    ids = utils.page_by_date(postings_list, meta_idx, calendar, page_size,
+                             sort_order, after)
+    next_cursor = None
+    if len(ids) == page_size:
+        next_cursor = utils.encode_cursor(id_to_date[ids[-1]], ids[-1])
+    return ids, next_cursor
+
+
+def collapse_duplicates(postings_list: BitMap) -> BitMap:
+    '''Only the canonical doc of each cluster of duplicates, if it is built'''
+    canonical = canonical_docs.get()
+    if canonical is None:
+        return postings_list
+    return postings_list & canonical
+
+
+def similar_doc_ids(doc_id: int, collapse: bool=False) -> [int]:
+    '''
+    Ids of the docs most similar to `doc_id`, without itself, see
+    `utils.collapse_similar` for `collapse`.
+    '''
+    similar = utils.get_sim_docs(doc_id, sim_docs=sim_docs.get())
+    if similar and similar[0] == doc_id:
+        similar = similar[1:]
+    if collapse and dup_clusters.get() is not None:
+        similar = utils.collapse_similar(doc_id, similar, dup_clusters.get())
+    return similar
+
+
+def add_snippets(docs: [dict], node) -> None:
+    '''Add the snippet of each doc, if the token store is built'''
+    store = snippet_store.get()
+    if store is None:
+        return
+    terms = utils.positive_terms(node, term_dict)
+    for doc in docs:
+        doc['snippet'] = store.snippet(doc['id'], terms)
+
+
+def suggest(node) -> dict:
+    '''
+    "Did you mean" for the terms of a query that are not in the index: the
+    suggestions of each term, and the query with each replaced by its first.
+    '''
+    terms = utils.missing_terms(node, inv_idx)
+    suggestions = {t: term_dict.suggest(t) for t in dict.fromkeys(terms)}
+    suggestions = {t: s for t, s in suggestions.items() if s}
+    if not suggestions:
+        return {}
+    best = {t: s[0] for t, s in suggestions.items()}
+    return {
+        'suggestions': suggestions,
+        'did_you_mean': utils.query_to_str(utils.replace_terms(node, best)),
+    }
+
+
+@app.route('/ready')
+@cross_origin(supports_credentials=True)
+def ready():
+    '''Readiness check, indexes are loaded at import so this is always ready'''
+    result = {
+        'status': 'ready',
+        'num_docs': NUM_DOCS,
+        'warm': is_warm,
+        'pid': os.getpid(),
+        'load_seconds': startup.load_seconds,
+    }
+    return jsonify(result)
 
 
 @app.route('/search')
 @cross_origin(supports_credentials=True)
+@limit_concurrency
 def search_bool_expr():
-    '''Parse boolean query expression and merge postings lists'''
+    '''
+    Parse boolean query expression and merge postings lists
+
+    Pages are given either by offsets (`min_index`, `max_index`), or by a
+    `cursor` ("" for the first page) and `page_size`, then the result has the
+    `next_cursor` of the next page (null after the last page).
+
+    With `snippets=1`, each doc has a "snippet" with the query terms
+    highlighted, see `snippets.py`. With `collapse=1`, near-duplicate docs
+    are collapsed into the canonical one, see `preprocess/dedup.py`.
+
+    If some terms are not in the index, the result has the `suggestions`
+    of each and the query with the best ones in `did_you_mean`.
+    '''
 
     # Parse query
     expr = request.args.get('query', None)
@@ -68,6 +373,14 @@ def search_bool_expr():
     max_index = request.args.get('max_index', None)
     min_date = request.args.get('min_date', None)
     max_date = request.args.get('max_date', None)
+    cursor = request.args.get('cursor', None)
+    try:
+        page_size = parse_page_size(request.args.get('page_size', None))
+    except ValueError:
+        result = {'status': 'error', 'message': 'invalid page_size'}
+        return jsonify(result)
+    with_snippets = request.args.get('snippets', '0') in ('1', 'true')
+    collapse = request.args.get('collapse', '0') in ('1', 'true')
     if min_index is not None:
         min_index = int(min_index)
     if max_index is not None:
@@ -75,9 +388,19 @@ def search_bool_expr():
 
     # 解析并处理布尔表达式
     print(f'Searching for {expr}')
+    timer = metrics.start_timer('search')
     try:
-        # NOTE: `process_boolean_query` returns a pyroaring `BitMap`
-        postings_list = utils.process_boolean_query(expr, inv_idx, NUM_DOCS)
+        node = utils.parse_query(expr, inv_idx, segmenter)
+        timer.query = node
+        check_cost(node, 'search')
+        timer.mark('parse')
+        # NOTE: `evaluate_query` returns a pyroaring `BitMap`
+        postings_list = utils.evaluate_query(node, inv_idx, NUM_DOCS,
+                                             metrics.new_cache(), meta_idx,
+                                             term_dict)
+        timer.mark('evaluate')
+    except utils.QueryTooExpensive as e:
+        return jsonify(too_expensive(e))
     except:
         # 表达式有问题，返回 error status
         result = {
@@ -87,26 +410,33 @@ def search_bool_expr():
         return jsonify(result)
 
     # 过滤和排序
-    filtered = postings_list
-    if sort_by == 'date':
-        # 从数据库获取所有 date
-        if min_date is not None:
-            filtered = [x for x in filtered if id_to_date[x] >= min_date]
-        if max_date is not None:
-            filtered = [x for x in filtered if id_to_date[x] <= max_date]
-        filtered = sorted(filtered, key=lambda x: id_to_date[x],
-                          reverse=sort_order == 'desc')
-    else:
+    if min_date is not None or max_date is not None:
+        postings_list = postings_list & utils.date_range_bitmap(
+            meta_idx, min_date, max_date)
+    if collapse:
+        postings_list = collapse_duplicates(postings_list)
+    timer.mark('filter')
+    if sort_by != 'date':
         raise ValueError(f'Invalid sort_by: {sort_by}')
-
-
-    filtered = list(filtered)  # Convert to list to make it JSON serializable
-    total_count = len(filtered)
+    total_count = len(postings_list)
     print('Length of final postings list:', total_count)
-    
+    if cursor is not None:
+        # 从 cursor 之后取一页，不需要排序
+        try:
+            filtered, next_cursor = cursor_page(postings_list, cursor,
+                                                page_size, sort_order)
+        except ValueError:
+            result = {'status': 'error', 'message': 'invalid cursor'}
+            return jsonify(result)
+        mode = admission.FULL
+    else:
+        # 结果太多时只选出所需的一页，或只返回总数
+        filtered, mode = sort_page(postings_list, sort_order, min_index,
+                                   max_index, 'search')
+    timer.mark('sort')
+
     # 只从数据库获取指定范围的文档
     print(f'Fetching first documents in range [{min_index}, {max_index})')
-    filtered = filtered[min_index:max_index]
     try:
         docs = utils.get_docs(filtered)
     except:
@@ -116,6 +446,10 @@ def search_bool_expr():
             'message': 'datebase error'
         }
         return jsonify(result)
+    timer.mark('fetch')
+    if with_snippets:
+        add_snippets(docs, node)
+        timer.mark('snippets')
 
     # 返回结果
     result = {
@@ -123,9 +457,284 @@ def search_bool_expr():
         'docs': docs,
         'total': total_count
     }
+    if cursor is not None:
+        result['next_cursor'] = next_cursor
+    if mode != admission.FULL:
+        result['degraded'] = mode
+    result.update(suggest(node))
+    timer.mark('suggest')
+    response = jsonify(result)
+    timer.mark('serialize')
+    timer.finish()
+    return response
+
+
+@app.route('/search_batch', methods=['POST'])
+@cross_origin(supports_credentials=True)
+@limit_concurrency
+def search_batch():
+    '''
+    Evaluate many boolean queries in one call, terms and sub-expressions shared
+    by the queries are evaluated once. The body is a JSON:
+    {
+        "queries": ["学习 and 读书", ...],
+        "min_date": "2003-01-01",   (optional)
+        "max_date": "2005-12-31",   (optional)
+        "with_ids": true,           (optional, return a page of sorted ids)
+        "sort_order": "desc",       (optional)
+        "min_index": 0,             (optional)
+        "max_index": 10,            (optional)
+        "histogram": "year"         (optional, a field of the metadata index:
+                                     "year", "month", "column", ...)
+    }
+    Return a result (with "status", "total", and "ids", "histogram" if asked)
+    for each query, in the same order.
+    '''
+    body = request.get_json()
+    queries = body['queries']
+    min_date = body.get('min_date', None)
+    max_date = body.get('max_date', None)
+    with_ids = body.get('with_ids', False)
+    sort_order = body.get('sort_order', 'desc')
+    min_index = body.get('min_index', 0)
+    max_index = body.get('max_index', None)
+    histogram = body.get('histogram', None)
+
+    print(f'Searching for {len(queries)} queries')
+    timer = metrics.start_timer('search_batch')
+    postings_lists = utils.process_boolean_queries(queries, inv_idx, NUM_DOCS,
+                                                   meta_idx, term_dict,
+                                                   segmenter,
+                                                   metrics.new_cache(),
+                                                   admission.MAX_QUERY_WORK
+                                                   * NUM_DOCS)
+    timer.mark('evaluate')
+    date_range = None
+    if min_date is not None or max_date is not None:
+        date_range = utils.date_range_bitmap(meta_idx, min_date, max_date)
+    results = []
+    for postings_list in postings_lists:
+        if isinstance(postings_list, utils.QueryTooExpensive):
+            metrics.rejected_queries.inc(endpoint='search_batch')
+            results.append(too_expensive(postings_list))
+            continue
+        if isinstance(postings_list, Exception):
+            results.append({'status': 'error', 'message': 'invalid query'})
+            continue
+        if date_range is not None:
+            postings_list = postings_list & date_range
+        timer.mark('filter')
+        result = {'status': 'success', 'total': len(postings_list)}
+        if with_ids:
+            result['ids'], mode = sort_page(postings_list, sort_order,
+                                            min_index, max_index,
+                                            'search_batch')
+            if mode != admission.FULL:
+                result['degraded'] = mode
+            timer.mark('sort')
+        if histogram is not None:
+            result['histogram'] = utils.facet_counts(postings_list,
+                                                     meta_idx[histogram])
+            timer.mark('facets')
+        results.append(result)
+
+    result = {'status': 'success', 'results': results}
+    response = jsonify(result)
+    timer.mark('serialize')
+    timer.finish()
+    return response
+
+
+@app.route('/aggregate')
+@cross_origin(supports_credentials=True)
+@limit_concurrency
+def aggregate():
+    '''
+    Count the results of a boolean query in every bucket of some fields of the
+    metadata index, without sorting or fetching any documents.
+
+    facets: comma separated fields, e.g. "year,column", default "year"
+    '''
+    expr = request.args.get('query', None)
+    facets = request.args.get('facets', 'year').split(',')
+    if any(f not in meta_idx for f in facets):
+        result = {'status': 'error', 'message': 'invalid facet'}
+        return jsonify(result)
+    timer = metrics.start_timer('aggregate')
+    try:
+        node = utils.parse_query(expr, inv_idx, segmenter)
+        timer.query = node
+        check_cost(node, 'aggregate')
+        timer.mark('parse')
+        postings_list = utils.evaluate_query(node, inv_idx, NUM_DOCS,
+                                             metrics.new_cache(), meta_idx,
+                                             term_dict)
+        timer.mark('evaluate')
+    except utils.QueryTooExpensive as e:
+        return jsonify(too_expensive(e))
+    except:
+        # 表达式有问题，返回 error status
+        result = {'status': 'error', 'message': 'invalid query'}
+        return jsonify(result)
+
+    result = {
+        'status': 'success',
+        'total': len(postings_list),
+        'facets': {f: utils.facet_counts(postings_list, meta_idx[f])
+                   for f in facets},
+    }
+    timer.mark('facets')
+    response = jsonify(result)
+    timer.mark('serialize')
+    timer.finish()
+    return response
+
+
+@app.route('/export')
+@cross_origin(supports_credentials=True)
+@limit_concurrency
+def export():
+    '''
+    Stream all results of a boolean query sorted by date, evaluated once, with
+    the docs fetched from Elasticsearch in batches while streaming.
+
+    query, sort_order, min_date, max_date: like `/search`
+    format: "ndjson" (default, a doc per line) or "csv"
+    fields: comma separated fields of the docs, default all (NDJSON) or
+        `EXPORT_CSV_FIELDS` (CSV)
+    cursor: resume an interrupted export after the doc of this cursor
+    limit: at most this number of docs
+
+    Each doc has its "cursor" (the first column in CSV), so that an export
+    can be resumed with the cursor of the last doc received.
+    '''
+    expr = request.args.get('query', None)
+    sort_order = request.args.get('sort_order', 'desc')
+    min_date = request.args.get('min_date', None)
+    max_date = request.args.get('max_date', None)
+    fmt = request.args.get('format', 'ndjson')
+    fields = request.args.get('fields', None)
+    cursor = request.args.get('cursor', None)
+    limit = request.args.get('limit', None)
+    if fmt not in ('ndjson', 'csv'):
+        result = {'status': 'error', 'message': 'invalid format'}
+        return jsonify(result)
+    if limit is not None:
+        if not limit.isdigit():
+            result = {'status': 'error', 'message': 'invalid limit'}
+            return jsonify(result)
+        limit = int(limit)
+    if fields is not None:
+        fields = fields.split(',')
+    elif fmt == 'csv':
+        fields = EXPORT_CSV_FIELDS
+
+    timer = metrics.start_timer('export')
+    try:
+        node = utils.parse_query(expr, inv_idx, segmenter)
+        timer.query = node
+        check_cost(node, 'export')
+        timer.mark('parse')
+        postings_list = utils.evaluate_query(node, inv_idx, NUM_DOCS,
+                                             metrics.new_cache(), meta_idx,
+                                             term_dict)
+        timer.mark('evaluate')
+    except utils.QueryTooExpensive as e:
+        return jsonify(too_expensive(e))
+    except:
+        # 表达式有问题，返回 error status
+        result = {'status': 'error', 'message': 'invalid query'}
+        return jsonify(result)
+    if min_date is not None or max_date is not None:
+        postings_list = postings_list & utils.date_range_bitmap(
+            meta_idx, min_date, max_date)
+    timer.mark('filter')
+    keys = np.sort(utils.date_keys(postings_list, id_to_date, sort_order))
+    try:
+        if cursor is not None:
+            keys = utils.keys_after(keys, cursor, sort_order)
+    except ValueError:
+        result = {'status': 'error', 'message': 'invalid cursor'}
+        return jsonify(result)
+    if limit is not None:
+        keys = keys[:limit]
+    ids = keys & 0xffffffff
+    timer.mark('sort')
+    timer.finish()
+
+    def get_fields(doc: dict) -> dict:
+        if fields is None:
+            return doc
+        return {f: doc.get(f) for f in fields}
+
+    def gen_ndjson():
+        for doc_id, doc in utils.iter_docs(ids, EXPORT_BATCH_SIZE):
+            doc = dict(get_fields(doc),
+                       cursor=utils.encode_cursor(id_to_date[doc_id], doc_id))
+            yield json.dumps(doc, ensure_ascii=False) + '\n'
+            metrics.exported_docs.inc()
+
+    def gen_csv():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(['cursor'] + fields)
+        yield buf.getvalue()
+        for doc_id, doc in utils.iter_docs(ids, EXPORT_BATCH_SIZE):
+            row = get_fields(doc)
+            if isinstance(row.get('content'), list):
+                row['content'] = '\n'.join(
+                    ''.join(''.join(sent) for sent in para)
+                    for para in row['content'])
+            buf.seek(0)
+            buf.truncate()
+            writer.writerow([utils.encode_cursor(id_to_date[doc_id], doc_id)]
+                            + [row[f] for f in fields])
+            yield buf.getvalue()
+            metrics.exported_docs.inc()
+
+    if fmt == 'csv':
+        return Response(gen_csv(), mimetype='text/csv')
+    return Response(gen_ndjson(), mimetype='application/x-ndjson')
+
+
+@app.route('/snippets')
+@cross_origin(supports_credentials=True)
+@limit_concurrency
+def get_snippets():
+    '''
+    Snippets of some docs for a query, for docs that are already fetched.
+
+    query: the boolean query
+    doc_ids: comma separated doc ids
+    '''
+    expr = request.args.get('query', None)
+    doc_ids = request.args.get('doc_ids', '')
+    store = snippet_store.get()
+    if store is None:
+        result = {'status': 'error', 'message': 'no token store'}
+        return jsonify(result)
+    try:
+        node = utils.parse_query(expr, inv_idx, segmenter)
+        doc_ids = [int(x) for x in doc_ids.split(',') if x]
+    except:
+        result = {'status': 'error', 'message': 'invalid query'}
+        return jsonify(result)
+    if not all(0 <= doc_id < store.num_docs for doc_id in doc_ids):
+        result = {'status': 'error', 'message': 'invalid doc id'}
+        return jsonify(result)
+    terms = utils.positive_terms(node, term_dict)
+    snippets = {doc_id: store.snippet(doc_id, terms) for doc_id in doc_ids}
+    result = {'status': 'success', 'snippets': snippets}
     return jsonify(result)
 
 
+@app.route('/metrics')
+def get_metrics():
+    '''Metrics in the Prometheus text format, see `metrics.py`'''
+    return Response(metrics.render_metrics(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/get_doc')
 @cross_origin(support_credentials=True)
 def get_doc():
@@ -149,17 +758,25 @@ def get_doc():
 @app.route('/get_similar_docs')
 @cross_origin(support_credentials=True)
 def get_similar_docs():
-    '''Given a doc ID, return 100 most similar documents'''
-    doc_id = request.args.get('doc_id', None)
-    assert doc_id is not None and doc_id.isnumeric()
+    '''
+    Given a doc ID, return 100 most similar documents, with `collapse=1`
+    each cluster of near-duplicates only once and none of the doc's own.
+    '''
+    doc_id = request.args.get('doc_id', '')
+    collapse = request.args.get('collapse', '0') in ('1', 'true')
+    if not doc_id.isdigit() or int(doc_id) >= NUM_DOCS:
+        result = {'status': 'error', 'message': 'invalid doc id'}
+        return jsonify(result)
     doc_id = int(doc_id)
     print('Getting similar docs of:', doc_id)
 
-    # TODO: Update this when sim docs are done
-    sim_docs = utils.get_sim_docs(doc_id)
-    # sim_docs = list(range(100))
-
-    docs = utils.get_docs(sim_docs)[1:]  # `1:` because the first doc is itself.
+    similar = similar_doc_ids(doc_id, collapse)
+    try:
+        docs = utils.get_docs(similar)
+    except:
+        # 无法从数据库获取文档，返回 error status
+        result = {'status': 'error', 'message': 'datebase error'}
+        return jsonify(result)
     result = {'status': 'success', 'docs': docs}
     return jsonify(result)
 
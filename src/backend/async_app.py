@@ -0,0 +1,237 @@
+'''
+Async (ASGI) variant of `app.py` with the same endpoints, built on Quart,
+which has the same API as Flask.
+
+CPU-bound work (evaluating queries, sorting, loading similar docs) runs in a
+bounded thread pool, and documents are fetched with the async Elasticsearch
+client, so a request waiting for Elasticsearch does not tie up a worker.
+
+Run in `src/backend` with an ASGI server, e.g.:
+
+    hypercorn async_app:app --bind 127.0.0.1:5000
+'''
+import os
+import asyncio
+from functools import partial, wraps
+from concurrent.futures import ThreadPoolExecutor
+
+from quart import Quart, request, jsonify, Response
+from quart_cors import cors
+from elasticsearch import AsyncElasticsearch
+
+import utils
+import metrics
+import admission
+# Loads the indexes once, shared with the Flask app.
+import app as sync_app
+
+app = cors(Quart(__name__), allow_origin='*')
+
+es_index = sync_app.es_index
+inv_idx = sync_app.inv_idx
+id_to_date = sync_app.id_to_date
+meta_idx = sync_app.meta_idx
+term_dict = sync_app.term_dict
+segmenter = sync_app.segmenter
+NUM_DOCS = sync_app.NUM_DOCS
+
+# Bounded pool for CPU-bound work, more threads don't help because of the GIL.
+CPU_WORKERS = min(4, os.cpu_count())
+executor = ThreadPoolExecutor(max_workers=CPU_WORKERS)
+# Number of docs per `mget`, the batches of a request are fetched concurrently.
+FETCH_BATCH_SIZE = 100
+es = None
+
+
+@app.before_serving
+async def open_es():
+    global es
+    es = AsyncElasticsearch()
+
+
+@app.after_serving
+async def close_es():
+    await es.close()
+
+
+async def run_cpu(func, *args):
+    '''Run `func(*args)` in the thread pool'''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args))
+
+
+async def fetch_docs(ids: [int]) -> [dict]:
+    '''
+    Async version of `utils.get_docs`, fetches batches of docs concurrently.
+    '''
+    async def fetch_batch(batch: [int]) -> [dict]:
+        res = await es.mget(index=es_index, body={'ids': batch})
+        return [doc['_source'] for doc in res['docs'] if doc['found']]
+
+    batches = [ids[i:i + FETCH_BATCH_SIZE]
+               for i in range(0, len(ids), FETCH_BATCH_SIZE)]
+    results = await asyncio.gather(*[fetch_batch(b) for b in batches])
+    return [doc for docs in results for doc in docs]
+
+
+def limit_concurrency(func):
+    '''Return an error (429) if the client has too many running requests'''
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        client = request.remote_addr
+        if not sync_app.limiter.acquire(client):
+            metrics.throttled_requests.inc(endpoint=func.__name__)
+            result = {'status': 'error', 'message': 'too many requests'}
+            return jsonify(result), 429
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            sync_app.limiter.release(client)
+    return wrapper
+
+
+@app.route('/search')
+@limit_concurrency
+async def search_bool_expr():
+    '''Parse boolean query expression and merge postings lists'''
+
+    # Parse query
+    expr = request.args.get('query', None)
+    sort_by = request.args.get('sort_by', 'date')
+    sort_order = request.args.get('sort_order', 'desc')
+    min_index = int(request.args.get('min_index', 0))
+    max_index = request.args.get('max_index', None)
+    min_date = request.args.get('min_date', None)
+    max_date = request.args.get('max_date', None)
+    cursor = request.args.get('cursor', None)
+    try:
+        page_size = sync_app.parse_page_size(
+            request.args.get('page_size', None))
+    except ValueError:
+        result = {'status': 'error', 'message': 'invalid page_size'}
+        return jsonify(result)
+    collapse = request.args.get('collapse', '0') in ('1', 'true')
+    with_snippets = request.args.get('snippets', '0') in ('1', 'true')
+    if max_index is not None:
+        max_index = int(max_index)
+    if sort_by != 'date':
+        raise ValueError(f'Invalid sort_by: {sort_by}')
+
+    # 解析并处理布尔表达式，然后过滤和排序
+    timer = metrics.start_timer('search')
+    def evaluate() -> ([int], int, str, str, dict, tuple):
+        node = utils.parse_query(expr, inv_idx, segmenter)
+        timer.query = node
+        sync_app.check_cost(node, 'search')
+        timer.mark('parse')
+        postings_list = utils.evaluate_query(node, inv_idx, NUM_DOCS,
+                                             metrics.new_cache(), meta_idx,
+                                             term_dict)
+        timer.mark('evaluate')
+        if min_date is not None or max_date is not None:
+            postings_list = postings_list & utils.date_range_bitmap(
+                meta_idx, min_date, max_date)
+        if collapse:
+            postings_list = sync_app.collapse_duplicates(postings_list)
+        timer.mark('filter')
+        next_cursor = None
+        if cursor is not None:
+            ids, next_cursor = sync_app.cursor_page(postings_list, cursor,
+                                                    page_size, sort_order)
+            mode = admission.FULL
+        else:
+            ids, mode = sync_app.sort_page(postings_list, sort_order,
+                                           min_index, max_index, 'search')
+        timer.mark('sort')
+        suggestions = sync_app.suggest(node)
+        timer.mark('suggest')
+        return ids, len(postings_list), mode, next_cursor, suggestions, node
+    try:
+        filtered, total_count, mode, next_cursor, suggestions, node = \
+            await run_cpu(evaluate)
+    except utils.QueryTooExpensive as e:
+        return jsonify(sync_app.too_expensive(e))
+    except:
+        # 表达式有问题，返回 error status
+        result = {
+            'status': 'error',
+            'message': 'invalid query'
+        }
+        return jsonify(result)
+
+    # 只从数据库获取指定范围的文档
+    try:
+        docs = await fetch_docs(filtered)
+    except:
+        # 无法从数据库获取文档，返回 error status
+        result = {
+            'status': 'error',
+            'message': 'datebase error'
+        }
+        return jsonify(result)
+    timer.mark('fetch')
+    if with_snippets:
+        await run_cpu(sync_app.add_snippets, docs, node)
+        timer.mark('snippets')
+
+    # 返回结果
+    result = {
+        'status': 'success',
+        'docs': docs,
+        'total': total_count
+    }
+    if cursor is not None:
+        result['next_cursor'] = next_cursor
+    if mode != admission.FULL:
+        result['degraded'] = mode
+    result.update(suggestions)
+    response = jsonify(result)
+    timer.mark('serialize')
+    timer.finish()
+    return response
+
+
+@app.route('/get_doc')
+async def get_doc():
+    '''
+    Get and return one document by ID.
+    '''
+    doc_id = request.args.get('doc_id', None)
+    try:
+        doc = (await fetch_docs([doc_id]))[0]
+    except:
+        # 无法从数据库获取文档，返回 error status
+        result = {'status': 'error', 'message': 'datebase error'}
+        return jsonify(result)
+    # 返回结果
+    result = {'status': 'success', 'doc': doc}
+    return jsonify(result)
+
+
+@app.route('/get_similar_docs')
+async def get_similar_docs():
+    '''Given a doc ID, return 100 most similar documents'''
+    doc_id = request.args.get('doc_id', '')
+    collapse = request.args.get('collapse', '0') in ('1', 'true')
+    if not doc_id.isdigit() or int(doc_id) >= NUM_DOCS:
+        result = {'status': 'error', 'message': 'invalid doc id'}
+        return jsonify(result)
+    doc_id = int(doc_id)
+
+    # Reading the pickle of similar docs is blocking I/O
+    similar = await run_cpu(sync_app.similar_doc_ids, doc_id, collapse)
+    try:
+        docs = await fetch_docs(similar)
+    except:
+        # 无法从数据库获取文档，返回 error status
+        result = {'status': 'error', 'message': 'datebase error'}
+        return jsonify(result)
+    result = {'status': 'success', 'docs': docs}
+    return jsonify(result)
+
+
+@app.route('/metrics')
+async def get_metrics():
+    '''Metrics in the Prometheus text format, see `metrics.py`'''
+    return Response(metrics.render_metrics(),
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,51 @@
+'''
+The date column: the date of each doc as a uint16 array of the number of days
+since 1970-01-01, indexed by doc id. Saved as `.npy` and memory-mapped, so it
+is loaded instantly and shared by forked workers, and sorting by date is done
+on integers (see `utils.sort_by_date`).
+'''
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+
+EPOCH = date(1970, 1, 1)
+
+
+def date_to_days(date_str: str) -> int:
+    '''"2000-01-01" -> 10957'''
+    return (date.fromisoformat(date_str) - EPOCH).days
+
+
+def days_to_date(days: int) -> str:
+    '''10957 -> "2000-01-01"'''
+    return (EPOCH + timedelta(days=int(days))).isoformat()
+
+
+def save_dates(days: [int], file: Path) -> None:
+    np.save(file, np.asarray(days, dtype=np.uint16))
+
+
+def load_dates(file: Path) -> np.ndarray:
+    '''Load a date column saved by `save_dates`, memory-mapped'''
+    return np.load(file, mmap_mode='r')
+
+
+def load_dates_txt(file: Path) -> np.ndarray:
+    '''
+    Read a date column from the old text format (a "doc_id\\tdate" per line),
+    for data built before the `.npy` one.
+    '''
+    days_of = {}   # Few distinct dates, parse each once
+    ids = []
+    days = []
+    with open(file, 'r') as f:
+        for line in f:
+            doc_id, date_str = line.strip().split('\t')
+            if date_str not in days_of:
+                days_of[date_str] = date_to_days(date_str)
+            ids.append(int(doc_id))
+            days.append(days_of[date_str])
+    res = np.zeros(max(ids) + 1 if ids else 0, dtype=np.uint16)
+    res[ids] = days
+    return res
@@ -0,0 +1,198 @@
+'''
+Metrics of the backend, exported at `/metrics` in the Prometheus text format:
+
+- request_stage_seconds: histogram of the time of each stage (parse,
+  evaluate, filter, sort, fetch, serialize) of each endpoint.
+- request_seconds: histogram of the total time of requests.
+- index_load_seconds: time to load each index at startup.
+- query_cache_{hits,misses}_total: sub-expression cache of `evaluate_query`.
+- {rejected,degraded}_queries_total, throttled_requests_total: admission
+  control, see `admission.py`.
+
+Requests slower than `SLOW_QUERY_SECONDS` are logged with the normalized
+query and the time of each stage.
+
+Set the environment variable `METRICS=0` to disable timing, then timers do
+nothing. With the pre-fork server, each worker has its own metrics.
+'''
+import os
+import json
+import time
+import logging
+import threading
+
+import utils
+
+ENABLED = os.environ.get('METRICS', '1') != '0'
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', '1.0'))
+# Upper bounds of the buckets of histograms, in seconds
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0]
+
+slow_query_logger = logging.getLogger('slow_query')
+if os.environ.get('SLOW_QUERY_LOG'):
+    slow_query_logger.addHandler(
+        logging.FileHandler(os.environ['SLOW_QUERY_LOG'], encoding='utf8'))
+
+_metrics = []
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Counter:
+    '''A counter (or a gauge, with `kind='gauge'`) with labels'''
+    def __init__(self, name: str, help: str, kind: str='counter'):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, value: float=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> [str]:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    '''A histogram with labels, with the buckets `BUCKETS`'''
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        # {labels: [count of each bucket, +Inf, sum]}
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(BUCKETS)] += 1
+            counts[-1] += value
+
+    def render(self) -> [str]:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ['+Inf'], counts):
+                    cumulative += count
+                    labels = format_labels(key + (('le', bound),))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(key)} {counts[-1]}')
+                lines.append(f'{self.name}_count{format_labels(key)} '
+                             f'{cumulative}')
+        return lines
+
+
+stage_seconds = Histogram('request_stage_seconds',
+                          'Time of each stage of requests')
+request_seconds = Histogram('request_seconds', 'Total time of requests')
+index_load_seconds = Counter('index_load_seconds',
+                             'Time to load each index at startup', 'gauge')
+cache_hits = Counter('query_cache_hits_total',
+                     'Sub-expressions found in the query cache')
+cache_misses = Counter('query_cache_misses_total',
+                       'Sub-expressions not found in the query cache')
+slow_queries = Counter('slow_queries_total', 'Number of slow requests')
+rejected_queries = Counter('rejected_queries_total',
+                           'Queries rejected by their estimated cost')
+degraded_queries = Counter('degraded_queries_total',
+                           'Queries with too many results to be sorted fully')
+exported_docs = Counter('exported_docs_total', 'Docs streamed by /export')
+throttled_requests = Counter('throttled_requests_total',
+                             'Requests over the concurrency limit of a client')
+
+
+def render_metrics() -> str:
+    '''All metrics in the Prometheus text format'''
+    return '\n'.join(line for m in _metrics for line in m.render()) + '\n'
+
+
+class CountingCache(dict):
+    '''The cache of `utils.evaluate_query`, counting hits and misses'''
+    def __contains__(self, key) -> bool:
+        found = dict.__contains__(self, key)
+        (cache_hits if found else cache_misses).inc()
+        return found
+
+
+class Timer:
+    '''
+    Times the stages of a request: call `mark(stage)` at the end of each
+    stage, and `finish()` at the end of the request.
+    '''
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.start = self.last = time.perf_counter()
+        self.stages = {}
+        self.query = None
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def finish(self):
+        total = time.perf_counter() - self.start
+        for stage, seconds in self.stages.items():
+            stage_seconds.observe(seconds, endpoint=self.endpoint, stage=stage)
+        request_seconds.observe(total, endpoint=self.endpoint)
+        if total >= SLOW_QUERY_SECONDS:
+            slow_queries.inc(endpoint=self.endpoint)
+            query = utils.query_to_str(self.query) if self.query else None
+            slow_query_logger.warning(json.dumps({
+                'endpoint': self.endpoint,
+                'query': query,
+                'seconds': round(total, 6),
+                'stages': {s: round(t, 6) for s, t in self.stages.items()},
+            }, ensure_ascii=False))
+
+
+class NullTimer:
+    '''Timer that does nothing, when metrics are disabled'''
+    query = None
+
+    def mark(self, stage: str):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def start_timer(endpoint: str):
+    return Timer(endpoint) if ENABLED else NULL_TIMER
+
+
+def new_cache() -> dict:
+    '''A cache for `utils.evaluate_query`'''
+    return CountingCache() if ENABLED else {}
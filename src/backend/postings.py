@@ -0,0 +1,365 @@
+'''
+Codecs for compressing postings lists (sorted doc ids), and an index of
+postings lists where each term is compressed with its own codec.
+
+- roaring: a run-optimized roaring bitmap, queries use it without decoding.
+- elias_fano: Elias-Fano coding, about 2 + log2(universe / n) bits per doc.
+- block_delta: the gaps between docs, bit-packed in blocks of 128 with the
+  bit width of each block, small when the docs of a term are clustered.
+
+All boolean operations are done on `BitMap`s, so elias_fano and block_delta
+lists are decoded when they are looked up.
+
+`MmapPostings` stores roaring bitmaps in a memory-mapped file, and only
+deserializes them when they are looked up, so that it loads instantly.
+'''
+import os
+import mmap
+import struct
+import threading
+import pickle as pkl
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from pyroaring import BitMap
+
+BLOCK_SIZE = 128
+# Terms in more than this fraction of docs are stored as roaring bitmaps,
+# which need no decoding (the most frequent terms are also the most queried
+# ones). Rare terms, most of the vocabulary, are stored more compactly and
+# are cheap to decode. See `bench/postings_bench.py` for the trade-off.
+DENSE_THRESHOLD = 1 / 4096
+# Max. number of postings lists `MmapPostings` keeps in each worker process
+# after `freeze`, see its docstring
+MAX_CACHED_TERMS = int(os.environ.get('MAX_CACHED_TERMS', '1000'))
+
+
+def to_bitmap(ids: np.ndarray) -> BitMap:
+    '''Sorted array of doc ids to `BitMap`, faster than `BitMap(ids)`'''
+    arr = array('I')
+    arr.frombytes(ids.astype(np.uint32).tobytes())
+    return BitMap(arr)
+
+
+def pack_bits(values: np.ndarray, widths: np.ndarray) -> (bytes, np.ndarray):
+    '''
+    Pack each value into its number of bits (little endian), return the
+    packed bytes and the bit offset of each value.
+    '''
+    widths = widths.astype(np.int64)
+    offsets = np.zeros(len(values), dtype=np.int64)
+    np.cumsum(widths[:-1], out=offsets[1:])
+    total = int(offsets[-1] + widths[-1]) if len(values) else 0
+    bits = np.zeros(total, dtype=np.uint8)
+    values = values.astype(np.uint64)
+    for k in range(int(widths.max()) if len(values) else 0):
+        mask = widths > k
+        bits[offsets[mask] + k] = (values[mask] >> np.uint64(k)) & 1
+    return np.packbits(bits, bitorder='little').tobytes(), offsets
+
+
+def unpack_bits(data: bytes, offsets: np.ndarray,
+                widths: np.ndarray) -> np.ndarray:
+    '''Inverse of `pack_bits`'''
+    max_width = int(widths.max()) if len(widths) else 0
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8),
+                         bitorder='little')
+    bits = np.concatenate([bits, np.zeros(max_width, dtype=np.uint8)])
+    values = np.zeros(len(offsets), dtype=np.uint64)
+    for k in range(max_width):
+        bit = bits[offsets + k].astype(np.uint64) * (widths > k)
+        values |= bit << np.uint64(k)
+    return values
+
+
+class RoaringCodec:
+    name = 'roaring'
+
+    @staticmethod
+    def encode(ids: np.ndarray, universe: int) -> bytes:
+        bitmap = to_bitmap(ids)
+        bitmap.run_optimize()
+        return bitmap.serialize()
+
+    @staticmethod
+    def decode(data: bytes) -> BitMap:
+        return BitMap.deserialize(data)
+
+
+class EliasFanoCodec:
+    '''
+    The low `l` bits of each id are stored as is, the high bits in unary:
+    the i-th id sets bit (id >> l) + i of the upper bit array.
+    '''
+    name = 'elias_fano'
+
+    @staticmethod
+    def encode(ids: np.ndarray, universe: int) -> bytes:
+        n = len(ids)
+        ids = ids.astype(np.int64)
+        l = max(0, int(np.floor(np.log2(universe / n)))) if n else 0
+        low, _ = pack_bits(ids & ((1 << l) - 1), np.full(n, l))
+        upper = np.zeros(n + (int(ids[-1]) >> l) + 1 if n else 0,
+                         dtype=np.uint8)
+        upper[(ids >> l) + np.arange(n)] = 1
+        high = np.packbits(upper, bitorder='little').tobytes()
+        return struct.pack('<III', n, l, len(low)) + low + high
+
+    @staticmethod
+    def decode(data: bytes) -> BitMap:
+        n, l, low_size = struct.unpack_from('<III', data)
+        low_data = data[12:12 + low_size]
+        upper = np.unpackbits(np.frombuffer(data, dtype=np.uint8,
+                                            offset=12 + low_size),
+                              bitorder='little')
+        high = np.flatnonzero(upper)[:n] - np.arange(n)
+        low = unpack_bits(low_data, np.arange(n, dtype=np.int64) * l,
+                          np.full(n, l))
+        return to_bitmap((high.astype(np.uint64) << np.uint64(l)) | low)
+
+
+class BlockDeltaCodec:
+    '''
+    The first id of each block is stored as is, the other ids as the gap to
+    the previous one, packed with the smallest bit width of the block.
+    '''
+    name = 'block_delta'
+
+    @staticmethod
+    def encode(ids: np.ndarray, universe: int) -> bytes:
+        n = len(ids)
+        ids = ids.astype(np.int64)
+        starts = np.arange(0, n, BLOCK_SIZE)
+        gaps = np.diff(ids, prepend=0)
+        gaps[starts] = 0
+        block_max = np.maximum.reduceat(gaps, starts) if n else gaps
+        block_widths = np.zeros(len(starts), dtype=np.uint8)
+        nonzero = block_max > 0
+        block_widths[nonzero] = np.floor(np.log2(block_max[nonzero])) + 1
+        widths = np.repeat(block_widths, BLOCK_SIZE)[:n]
+        packed, _ = pack_bits(gaps, widths)
+        return (struct.pack('<I', n) + ids[starts].astype(np.uint32).tobytes()
+                + block_widths.tobytes() + packed)
+
+    @staticmethod
+    def decode(data: bytes) -> BitMap:
+        n, = struct.unpack_from('<I', data)
+        num_blocks = -(-n // BLOCK_SIZE)
+        bases = np.frombuffer(data, dtype=np.uint32, count=num_blocks, offset=4)
+        offset = 4 + 4 * num_blocks
+        block_widths = np.frombuffer(data, dtype=np.uint8, count=num_blocks,
+                                     offset=offset)
+        widths = np.repeat(block_widths.astype(np.int64), BLOCK_SIZE)[:n]
+        offsets = np.zeros(n, dtype=np.int64)
+        np.cumsum(widths[:-1], out=offsets[1:])
+        gaps = unpack_bits(data[offset + num_blocks:], offsets, widths)
+        # Cumulative sum of the gaps within each block
+        sums = np.cumsum(gaps.astype(np.int64))
+        block_sums = sums[np.arange(0, n, BLOCK_SIZE)]
+        ids = np.repeat(bases.astype(np.int64) - block_sums, BLOCK_SIZE)[:n]
+        return to_bitmap(ids + sums)
+
+
+CODECS = {c.name: c for c in [RoaringCodec, EliasFanoCodec, BlockDeltaCodec]}
+
+
+def choose_codec(ids: np.ndarray, universe: int,
+                 dense_threshold: float=DENSE_THRESHOLD) -> (str, bytes):
+    '''
+    Encode a postings list with the codec for its density: roaring for lists
+    with more than `dense_threshold * universe` docs, otherwise the smaller
+    of elias_fano and block_delta (the latter is smaller when the docs are
+    clustered). Return (codec name, data).
+    '''
+    if len(ids) >= dense_threshold * universe:
+        return 'roaring', RoaringCodec.encode(ids, universe)
+    candidates = [(c.name, c.encode(ids, universe))
+                  for c in [EliasFanoCodec, BlockDeltaCodec]]
+    return min(candidates, key=lambda x: len(x[1]))
+
+
+class PostingsIndex:
+    '''
+    {term: postings list} where each postings list is stored with its own
+    codec. Roaring lists are deserialized when loaded, the others are decoded
+    to a `BitMap` on each lookup. Has the read-only interface of a dict of
+    `BitMap`s, which is what `utils.evaluate_query` uses.
+    '''
+    def __init__(self, encoded: {str: (str, bytes)}, universe: int):
+        self.encoded = encoded
+        self.universe = universe
+        self.bitmaps = {t: RoaringCodec.decode(data)
+                        for t, (codec, data) in encoded.items()
+                        if codec == 'roaring'}
+
+    @classmethod
+    def build(cls, postings_lists: {str: [int]}, universe: int,
+              codec: str=None,
+              dense_threshold: float=DENSE_THRESHOLD) -> 'PostingsIndex':
+        '''Encode all postings lists with `codec`, default: `choose_codec`'''
+        encoded = {}
+        for term, ids in postings_lists.items():
+            if isinstance(ids, BitMap):
+                ids = np.frombuffer(ids.to_array(), dtype=np.uint32)
+            ids = np.asarray(ids, dtype=np.uint32)
+            if codec is None:
+                encoded[term] = choose_codec(ids, universe, dense_threshold)
+            else:
+                encoded[term] = (codec, CODECS[codec].encode(ids, universe))
+        return cls(encoded, universe)
+
+    def save(self, file: Path) -> None:
+        with open(file, 'wb') as f:
+            pkl.dump({'universe': self.universe, 'encoded': self.encoded}, f,
+                     protocol=pkl.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, file: Path) -> 'PostingsIndex':
+        with open(file, 'rb') as f:
+            data = pkl.load(f)
+        return cls(data['encoded'], data['universe'])
+
+    def nbytes(self) -> int:
+        '''Total size of the encoded postings lists'''
+        return sum(len(data) for _, data in self.encoded.values())
+
+    def codec_counts(self) -> {str: int}:
+        counts = {}
+        for codec, _ in self.encoded.values():
+            counts[codec] = counts.get(codec, 0) + 1
+        return counts
+
+    def cardinality(self, term: str) -> int:
+        '''Number of docs of a term (0 if unknown), without decoding it'''
+        if term in self.bitmaps:
+            return len(self.bitmaps[term])
+        if term not in self.encoded:
+            return 0
+        # elias_fano and block_delta data start with the number of ids
+        return struct.unpack_from('<I', self.encoded[term][1])[0]
+
+    def __getitem__(self, term: str) -> BitMap:
+        if term in self.bitmaps:
+            return self.bitmaps[term]
+        codec, data = self.encoded[term]
+        return CODECS[codec].decode(data)
+
+    def get(self, term: str, default: BitMap=None) -> BitMap:
+        return self[term] if term in self.encoded else default
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.encoded
+
+    def __len__(self) -> int:
+        return len(self.encoded)
+
+    def __iter__(self):
+        return iter(self.encoded)
+
+    def keys(self):
+        return self.encoded.keys()
+
+    def values(self):
+        return (self[t] for t in self.encoded)
+
+    def items(self):
+        return ((t, self[t]) for t in self.encoded)
+
+
+class MmapPostings:
+    '''
+    {term: BitMap} in a memory-mapped file of serialized roaring bitmaps.
+    Loading only reads the offsets of the terms, each postings list is
+    deserialized on its first lookup and then kept. Has the read-only
+    interface of a dict of `BitMap`s, like `PostingsIndex`.
+
+    pyroaring can only deserialize into a copy, not a view of the mmap, so a
+    bitmap deserialized in a forked worker is private to that worker. The
+    pre-fork server deserializes the hot terms in the master (`warm_up`),
+    then calls `freeze`: those bitmaps are shared by all workers, and each
+    worker keeps at most `max_cached` others (least recently used evicted),
+    so the private memory of a worker is bounded.
+
+    The file is the length of the header (uint64), the pickled header
+    {term: (offset, size, cardinality)}, then the bitmaps.
+    '''
+    def __init__(self, file: Path, max_cached: int=MAX_CACHED_TERMS):
+        with open(file, 'rb') as f:
+            header_size = struct.unpack('<Q', f.read(8))[0]
+            self.offsets = pkl.loads(f.read(header_size))
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.base = 8 + header_size
+        self.bitmaps = {}   # Loaded before `freeze`, kept
+        self.cache = OrderedDict()  # Loaded after, in the order of last use
+        self.cache_lock = threading.Lock()
+        self.max_cached = max_cached
+        self.frozen = False
+
+    @staticmethod
+    def save(postings_lists: {str: BitMap}, file: Path) -> None:
+        offsets = {}
+        chunks = []
+        offset = 0
+        for term, bitmap in postings_lists.items():
+            data = bitmap.serialize()
+            offsets[term] = (offset, len(data), len(bitmap))
+            chunks.append(data)
+            offset += len(data)
+        header = pkl.dumps(offsets, protocol=pkl.HIGHEST_PROTOCOL)
+        with open(file, 'wb') as f:
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for data in chunks:
+                f.write(data)
+
+    def cardinality(self, term: str) -> int:
+        '''Number of docs of a term (0 if unknown), without loading it'''
+        return self.offsets[term][2] if term in self.offsets else 0
+
+    def freeze(self) -> None:
+        '''Keep the bitmaps loaded so far, bound the ones loaded later'''
+        self.frozen = True
+
+    def __getitem__(self, term: str) -> BitMap:
+        bitmap = self.bitmaps.get(term)
+        if bitmap is not None:
+            return bitmap
+        with self.cache_lock:
+            bitmap = self.cache.get(term)
+            if bitmap is not None:
+                self.cache.move_to_end(term)
+                return bitmap
+        offset, size, _ = self.offsets[term]
+        start = self.base + offset
+        bitmap = BitMap.deserialize(self.data[start:start + size])
+        if not self.frozen:
+            self.bitmaps[term] = bitmap
+            return bitmap
+        with self.cache_lock:
+            self.cache[term] = bitmap
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+        return bitmap
+
+    def get(self, term: str, default: BitMap=None) -> BitMap:
+        return self[term] if term in self.offsets else default
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def values(self):
+        return (self[t] for t in self.offsets)
+
+    def items(self):
+        return ((t, self[t]) for t in self.offsets)
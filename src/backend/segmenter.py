@@ -0,0 +1,54 @@
+'''
+Dictionary-based segmentation of query terms, so that an unsegmented phrase
+such as "人民日报社论" can be matched against the index, whose terms are
+THULAC tokens. THULAC itself is not needed when serving.
+
+Each segmentation of the text is a path in the DAG of the words of the
+lexicon it contains, the path maximizing the sum of the log frequencies of
+its words is taken (unigram language model, as in jieba).
+'''
+from math import log
+
+# Longer words in the lexicon are ignored, to bound the lookups per char.
+MAX_WORD_LEN = 8
+
+
+class Segmenter:
+    '''
+    Segmenter over a lexicon of {word: frequency}, e.g. the doc. freq. of the
+    corpus stats. The lexicon is used as is (not copied).
+    '''
+    def __init__(self, word_freq: {str: int}, max_word_len: int=MAX_WORD_LEN):
+        self.word_freq = word_freq
+        self.max_word_len = max_word_len
+        self.log_total = log(sum(word_freq.values()) or 1)
+
+    def get_dag(self, text: str) -> [[int]]:
+        '''dag[i] is the list of ends j of the words text[i:j] in the lexicon'''
+        n = len(text)
+        dag = []
+        for i in range(n):
+            ends = [j for j in range(i + 2, min(n, i + self.max_word_len) + 1)
+                    if text[i:j] in self.word_freq]
+            ends.append(i + 1)  # A single char is always allowed
+            dag.append(ends)
+        return dag
+
+    def cut(self, text: str) -> [str]:
+        '''Split `text` into the most probable sequence of words'''
+        n = len(text)
+        dag = self.get_dag(text)
+        # route[i] = (best log prob. of text[i:], end of first word)
+        route = [None] * n + [(0.0, n)]
+        for i in range(n - 1, -1, -1):
+            route[i] = max(
+                (log(self.word_freq.get(text[i:j], 0) or 1) - self.log_total
+                 + route[j][0], j)
+                for j in dag[i])
+        words = []
+        i = 0
+        while i < n:
+            j = route[i][1]
+            words.append(text[i:j])
+            i = j
+        return words
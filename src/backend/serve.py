@@ -0,0 +1,94 @@
+'''
+Production entry point of the backend, instead of `flask run`.
+
+The indexes are loaded (when importing `app`) and warmed up once in the master
+process, then `--workers` processes are forked to serve requests on a shared
+listening socket. The workers never modify the indexes, so their memory pages
+are shared copy-on-write instead of being loaded N times.
+
+Usage: python serve.py --workers 8 --port 5000
+'''
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import argparse
+
+from werkzeug.serving import make_server
+
+import app as backend
+
+
+def serve_worker(sock: socket.socket, threaded: bool) -> None:
+    '''Serve forever on the listening socket, run in a forked worker'''
+    # Stop serving on SIGTERM from the master, and don't inherit its handlers
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    server = make_server(*sock.getsockname()[:2], backend.app,
+                         threaded=threaded, fd=sock.fileno())
+    print(f'Worker {os.getpid()} serving')
+    server.serve_forever()
+
+
+def fork_worker(sock: socket.socket, threaded: bool) -> int:
+    '''Fork a worker process, return its pid'''
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve_worker(sock, threaded)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threaded', action='store_true',
+                        help='Use a thread per request in each worker, helps '
+                             'when requests mostly wait for Elasticsearch')
+    parser.add_argument('--warm-up-terms', type=int, default=1000,
+                        help='Number of most frequent postings to page in')
+    args = parser.parse_args()
+
+    backend.warm_up(args.warm_up_terms)
+
+    # Objects that exist now are never collected, so the garbage collector in
+    # workers does not write to (and thus copy) the pages holding the indexes.
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    print(f'Listening on http://{args.host}:{args.port} with {args.workers} '
+          'workers')
+
+    workers = set()
+    for _ in range(args.workers):
+        workers.add(fork_worker(sock, args.threaded))
+
+    def shutdown(*args):
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # Replace workers that die
+    while True:
+        pid, status = os.wait()
+        if pid in workers:
+            workers.remove(pid)
+            print(f'Worker {pid} exited with status {status}, restarting')
+            time.sleep(1)
+            workers.add(fork_worker(sock, args.threaded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Snippets of docs with the query terms highlighted, built from the token store
+of `preprocess/token_store.py` instead of the docs in Elasticsearch.
+
+The snippet of a doc is the window of `WINDOW` consecutive sentences with the
+most distinct query terms, then the most occurrences of them (the first
+sentences if there is none), at most `MAX_CHARS` chars around the first
+highlight.
+'''
+from bisect import bisect_left
+from pathlib import Path
+
+import numpy as np
+
+WINDOW = 2
+MAX_CHARS = 160
+
+
+class SnippetStore:
+    '''The token store, memory-mapped, see `preprocess/token_store.py`'''
+    def __init__(self, store_dir: Path):
+        store_dir = Path(store_dir)
+        with open(store_dir / 'lexicon.txt', 'r', encoding='utf8') as f:
+            self.lexicon = f.read().split('\n')
+        self.tokens = np.load(store_dir / 'tokens.npy', mmap_mode='r')
+        self.sent_starts = np.load(store_dir / 'sent_starts.npy',
+                                   mmap_mode='r')
+        self.doc_sents = np.load(store_dir / 'doc_sents.npy', mmap_mode='r')
+        self.num_docs = len(self.doc_sents) - 1
+
+    def token_id(self, token: str) -> int:
+        '''Id of a token, None if it is not in any doc'''
+        i = bisect_left(self.lexicon, token)
+        if i < len(self.lexicon) and self.lexicon[i] == token:
+            return i
+        return None
+
+    def snippet(self, doc_id: int, terms: [str], window: int=WINDOW,
+                max_chars: int=MAX_CHARS) -> dict:
+        '''
+        Return {"text": str, "highlights": [[start, end], ...]}, where the
+        highlights are the offsets of the occurrences of `terms` in the text.
+        Raises IndexError if there is no doc `doc_id`.
+        '''
+        if not 0 <= doc_id < self.num_docs:
+            raise IndexError(f'No doc {doc_id} in the token store')
+        first_sent, end_sent = self.doc_sents[doc_id:doc_id + 2]
+        starts = np.asarray(self.sent_starts[first_sent:end_sent + 1])
+        if len(starts) < 2:
+            return {'text': '', 'highlights': []}
+        tokens = np.asarray(self.tokens[starts[0]:starts[-1]])
+        starts = starts - starts[0]
+        term_ids = sorted({i for i in map(self.token_id, terms)
+                           if i is not None})
+
+        # Count the hits in each window of sentences with cumulative sums
+        num_windows = max(len(starts) - window, 1)
+        win_starts = starts[:num_windows]
+        win_ends = starts[-num_windows:]
+        hits = np.isin(tokens, term_ids)
+        cum_hits = np.concatenate([[0], np.cumsum(hits)])
+        scores = cum_hits[win_ends] - cum_hits[win_starts]
+        for term_id in term_ids:
+            cum = np.concatenate([[0], np.cumsum(tokens == term_id)])
+            has_term = cum[win_ends] > cum[win_starts]
+            scores = scores + has_term * (len(tokens) + 1)
+        best = int(np.argmax(scores))
+
+        text = []
+        highlights = []
+        pos = 0
+        for i in range(win_starts[best], win_ends[best]):
+            token = self.lexicon[tokens[i]]
+            if hits[i]:
+                highlights.append([pos, pos + len(token)])
+            text.append(token)
+            pos += len(token)
+        text = ''.join(text)
+        if len(text) > max_chars:
+            start = max(highlights[0][0] - max_chars // 4, 0) \
+                if highlights else 0
+            start = min(start, len(text) - max_chars)
+            text = text[start:start + max_chars]
+            highlights = [[s - start, e - start] for s, e in highlights
+                          if s >= start and e <= start + max_chars]
+        return {'text': text, 'highlights': highlights}
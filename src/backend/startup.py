@@ -0,0 +1,70 @@
+'''
+Loading the artifacts of the backend at startup.
+
+Independent artifacts are loaded concurrently by `load_parallel` (reading
+files and numpy release the GIL), and the ones that are not needed by most
+requests are wrapped in `Lazy`, which loads them on first use. The time of
+each load is recorded in `load_seconds`, which `report` formats, and in the
+`index_load_seconds` metric.
+'''
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+load_seconds = {}   # {name: seconds}, in the order the loads finished
+
+
+def timed(name: str, load, *args):
+    '''Return `load(*args)`, and record its time'''
+    start_time = time.time()
+    res = load(*args)
+    seconds = time.time() - start_time
+    load_seconds[name] = seconds
+    metrics.index_load_seconds.set(seconds, index=name)
+    return res
+
+
+def load_parallel(loads: {str: tuple}, max_workers: int=4) -> dict:
+    '''
+    Run the loads {name: (load, *args)} concurrently, return
+    {name: load(*args)}.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {name: executor.submit(timed, name, *load)
+                   for name, load in loads.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+class Lazy:
+    '''
+    An artifact that is loaded by `load(*args)` on first use, either with
+    `get()` or by accessing any of its attributes through this object.
+    '''
+    def __init__(self, name: str, load, *args):
+        self.name = name
+        self.load = load
+        self.args = args
+        self.value = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.value = timed(self.name, self.load, *self.args)
+                    self.loaded = True
+        return self.value
+
+    def __getattr__(self, attr: str):
+        return getattr(self.get(), attr)
+
+
+def report(total_seconds: float) -> str:
+    '''The startup timing breakdown'''
+    lines = [f'Ready in {total_seconds:.3f}s:']
+    for name, seconds in load_seconds.items():
+        lines.append(f'  {name:<16}{seconds:.3f}s')
+    return '\n'.join(lines)
@@ -0,0 +1,224 @@
+'''
+A term dictionary for expanding query terms with wildcards and typos into the
+terms of the vocabulary, e.g. "经济*" -> ["经济", "经济学", "经济体", ...].
+
+The terms are kept in a sorted list, so the terms with a given prefix are a
+contiguous range found by binary search. Fuzzy (edit distance) lookup uses a
+"symmetric delete" index: the strings obtained by deleting up to `max_dist`
+chars of each term, two strings within distance `max_dist` always share one.
+Only the hashes of the deletes are kept, in a sorted array with the term of
+each, so the index is small enough to be in every worker; a hash collision
+only adds a candidate, which is then checked by its edit distance. It is
+built on the first fuzzy lookup, since it is larger than the terms.
+
+With the frequency of each term, `suggest` gives "did you mean" suggestions
+for terms that are not in the vocabulary: the closest, most frequent terms.
+'''
+import re
+import pickle as pkl
+from bisect import bisect_left
+from pathlib import Path
+
+import numpy as np
+
+# Max. number of terms a wildcard or fuzzy term expands into.
+MAX_EXPANSIONS = 100
+# Number of suggestions of a term
+MAX_SUGGESTIONS = 3
+# Terms shorter than this get no suggestions, a single char is within 1 of
+# nearly every 1 or 2-char term
+MIN_SUGGEST_LEN = 2
+# Max. number of terms whose edit distance is checked in a fuzzy lookup
+MAX_CANDIDATES = 200
+
+
+def edit_distance(a: str, b: str, max_dist: int=None) -> int:
+    '''
+    Levenshtein distance between two strings, stops early and returns
+    `max_dist + 1` if the distance is larger than `max_dist`.
+    '''
+    if max_dist is not None and abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    # The common prefix and suffix do not change the distance
+    start = 0
+    while start < min(len(a), len(b)) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while (end < min(len(a), len(b)) - start
+           and a[len(a) - 1 - end] == b[len(b) - 1 - end]):
+        end += 1
+    a = a[start:len(a) - end]
+    b = b[start:len(b) - end]
+    if not a or not b:
+        return len(a) + len(b)
+    if max_dist is not None and max_dist <= 1:
+        # Within 1 only if what is left is a single substitution
+        return 1 if len(a) == len(b) == 1 else max_dist + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1,
+                           prev[j - 1] + (ca != cb)))
+        if max_dist is not None and min(cur) > max_dist:
+            return max_dist + 1
+        prev = cur
+    if max_dist is not None:
+        return min(prev[-1], max_dist + 1)
+    return prev[-1]
+
+
+def get_deletes(term: str, max_dist: int) -> {str}:
+    '''All strings obtained by deleting at most `max_dist` chars of `term`'''
+    deletes = {term}
+    frontier = {term}
+    for _ in range(max_dist):
+        frontier = {s[:i] + s[i + 1:] for s in frontier for i in range(len(s))}
+        deletes |= frontier
+    return deletes
+
+
+class TermDict:
+    '''
+    Sorted array of the terms of the vocabulary, supports prefix, wildcard
+    and fuzzy lookup. All lookups return at most `limit` terms.
+    '''
+    def __init__(self, terms: [str], max_dist: int=2,
+                 freqs: {str: int}=None):
+        self.terms = sorted(set(terms))
+        self.max_dist = max_dist
+        self.freqs = freqs or {}
+        # Hashes of the deletes, sorted, and the index of the term of each
+        self.delete_hashes = None
+        self.delete_terms = None
+
+    @classmethod
+    def from_vocab(cls, file: Path, max_dist: int=2,
+                   freq_file: Path=None) -> 'TermDict':
+        '''
+        Load from `vocab.txt`, one term per line, and the frequencies of the
+        terms from `token_freq.pkl` if given.
+        '''
+        with open(file, 'r', encoding='utf8') as f:
+            terms = [line.rstrip('\n') for line in f if line.strip()]
+        freqs = None
+        if freq_file is not None:
+            with open(freq_file, 'rb') as f:
+                token_freq = pkl.load(f)
+            freqs = {t: token_freq.get(t, 0) for t in terms}
+        return cls(terms, max_dist, freqs)
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __contains__(self, term: str) -> bool:
+        i = bisect_left(self.terms, term)
+        return i < len(self.terms) and self.terms[i] == term
+
+    def prefix(self, prefix: str, limit: int=MAX_EXPANSIONS) -> [str]:
+        '''Terms starting with `prefix`, in sorted order'''
+        res = []
+        i = bisect_left(self.terms, prefix)
+        while i < len(self.terms) and len(res) < limit:
+            if not self.terms[i].startswith(prefix):
+                break
+            res.append(self.terms[i])
+            i += 1
+        return res
+
+    def wildcard(self, pattern: str, limit: int=MAX_EXPANSIONS) -> [str]:
+        '''
+        Terms matching a pattern where "*" matches any chars and "?" matches
+        one char. Only the terms with the prefix before the first wildcard
+        are scanned, so a pattern starting with a wildcard scans all terms.
+        '''
+        literal = re.split(r'[*?]', pattern, 1)[0]
+        if len(literal) == len(pattern):
+            return [pattern] if pattern in self else []
+        if pattern == literal + '*':
+            return self.prefix(literal, limit)
+        regex = re.compile(''.join(
+            '.*' if c == '*' else '.' if c == '?' else re.escape(c)
+            for c in pattern))
+        res = []
+        i = bisect_left(self.terms, literal)
+        while i < len(self.terms) and len(res) < limit:
+            term = self.terms[i]
+            if not term.startswith(literal):
+                break
+            if regex.fullmatch(term):
+                res.append(term)
+            i += 1
+        return res
+
+    def build_deletes(self) -> None:
+        '''Build the delete index, see the module docstring'''
+        hashes = []
+        term_ids = []
+        for i, term in enumerate(self.terms):
+            for s in get_deletes(term, self.max_dist):
+                hashes.append(hash(s))
+                term_ids.append(i)
+        hashes = np.array(hashes, dtype=np.int64)
+        order = np.argsort(hashes, kind='stable')
+        self.delete_hashes = hashes[order]
+        self.delete_terms = np.array(term_ids, dtype=np.int32)[order]
+
+    def within(self, term: str, max_dist: int) -> [(int, str)]:
+        '''
+        (distance, term) of the terms within `max_dist` of `term`. At most
+        `MAX_CANDIDATES` terms are checked, those sharing the longest deletes
+        with `term` first, so short deletes shared by many terms (like "")
+        cannot make a lookup slow.
+        '''
+        if max_dist > self.max_dist:
+            raise ValueError(f'Max. edit distance is {self.max_dist}, '
+                             f'got {max_dist}')
+        if self.delete_hashes is None:
+            self.build_deletes()
+        candidates = set()
+        for s in sorted(get_deletes(term, max_dist), key=len, reverse=True):
+            h = hash(s)
+            lo = np.searchsorted(self.delete_hashes, h, 'left')
+            hi = np.searchsorted(self.delete_hashes, h, 'right')
+            hi = min(hi, lo + MAX_CANDIDATES - len(candidates))
+            candidates.update(self.delete_terms[lo:hi].tolist())
+            if len(candidates) >= MAX_CANDIDATES:
+                break
+        res = []
+        for i in candidates:
+            dist = edit_distance(term, self.terms[i], max_dist)
+            if dist <= max_dist:
+                res.append((dist, self.terms[i]))
+        return res
+
+    def fuzzy(self, term: str, max_dist: int=1,
+              limit: int=MAX_EXPANSIONS) -> [str]:
+        '''
+        Terms within edit distance `max_dist` of `term`, closest first, then
+        in sorted order. The distance is at most `len(term) - 1`: any term of
+        up to `max_dist` chars is within `max_dist` of every short term.
+        '''
+        max_dist = min(max_dist, len(term) - 1)
+        if max_dist <= 0:
+            return [term] if term in self else []
+        return [t for _, t in sorted(self.within(term, max_dist))[:limit]]
+
+    def suggest(self, term: str, limit: int=MAX_SUGGESTIONS) -> [str]:
+        '''
+        "Did you mean" suggestions for a term: the closest terms, the most
+        frequent first. The max. distance is 1 for terms of at most 2 chars,
+        since most 2-char terms are within 2 of each other, and terms shorter
+        than `MIN_SUGGEST_LEN` (e.g. stop words) get none.
+        '''
+        if len(term) < MIN_SUGGEST_LEN:
+            return []
+        max_dist = min(self.max_dist, 1 if len(term) <= 2 else 2)
+        # Closer terms come first, so search farther only if there are not
+        # enough of them
+        for dist in range(1, max_dist + 1):
+            res = [(d, -self.freqs.get(t, 0), t)
+                   for d, t in self.within(term, dist) if t != term]
+            if len(res) >= limit:
+                break
+        return [t for _, _, t in sorted(res)[:limit]]
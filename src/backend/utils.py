@@ -1,5 +1,13 @@
+import re
+import heapq
+import base64
+import struct
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import pickle as pkl
+import numpy as np
 from elasticsearch import Elasticsearch
 from pyroaring import BitMap
 
@@ -8,6 +16,22 @@ es_index = 'rmrb_00-15'
 es_index_date = 'rmrb_00-15-date'  # An index for dates for faster date lookup
 
 
+def load_corpus_stats(file: Path) -> dict:
+    '''
+    Load the corpus stats built by `preprocess/stats.py`: number of docs, doc
+    lengths and doc freq. of each term (used by the segmenter).
+    '''
+    data = np.load(file)
+    terms = data['terms'].tobytes().decode('utf8').split('\n')
+    doc_lens = data['doc_lens']
+    return {
+        'num_docs': len(doc_lens),
+        'doc_lens': doc_lens,
+        'avg_doc_len': float(doc_lens.mean()),
+        'doc_freq': dict(zip(terms, data['doc_freq'].tolist())),
+    }
+
+
 def get_docs_iter(ids: [int], min_index: int, max_index: int, min_date: str, 
              max_date: str, sort_order: str='desc') -> [dict]:
     '''
@@ -64,6 +88,33 @@ def get_docs(ids: [int]) -> [dict]:
     return found_docs
 
 
+def iter_docs(ids: [int], batch_size: int=500, prefetch: int=2):
+    '''
+    Yield (doc id, doc) of the docs found in Elasticsearch, in the order of
+    `ids`. Docs are fetched by `mget` in batches of `batch_size`, and the next
+    `prefetch` batches are fetched in the background while a batch is being
+    consumed, so only these batches are in memory.
+    '''
+    es = Elasticsearch()
+
+    def fetch(batch: [int]) -> [tuple]:
+        res = es.mget(index=es_index, body={'ids': batch})
+        return [(int(doc['_id']), doc['_source'])
+                for doc in res['docs'] if doc['found']]
+
+    batches = ([int(x) for x in ids[i:i + batch_size]]
+               for i in range(0, len(ids), batch_size))
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        futures = deque(executor.submit(fetch, batch)
+                        for _, batch in zip(range(prefetch), batches))
+        while futures:
+            docs = futures.popleft().result()
+            batch = next(batches, None)
+            if batch is not None:
+                futures.append(executor.submit(fetch, batch))
+            yield from docs
+
+
 def get_dates(ids: [int]) -> [str]:
     '''Given a list of doc ids, return a list of corresponding dates.'''
     assert ids is not None
@@ -79,13 +130,181 @@ def get_dates(ids: [int]) -> [str]:
     return found_dates
 
 
-def process_boolean_query(bool_expr: str, postings_lists: {str: BitMap}, 
-                          num_docs: int) -> BitMap:
-    '''Given a string of boolean query, compute the resulting postings list'''
+def date_keys(postings_list: BitMap, id_to_date: np.ndarray,
+              sort_order: str) -> np.ndarray:
+    '''
+    Keys (date, doc id) of the docs as int64, whose order is the order of
+    `sort_by_date`: by date, and by increasing doc id for the same date.
+    '''
+    ids = np.frombuffer(postings_list.to_array(), dtype=np.uint32)
+    days = id_to_date[ids].astype(np.int64)
+    if sort_order == 'desc':
+        days = -days
+    return (days << 32) | ids
 
-    # 用两个栈来实现表达式计算
-    op_stack = []
-    set_stack = []
+
+def date_key(days: int, doc_id: int, sort_order: str) -> int:
+    '''The key of a doc in `date_keys`'''
+    return ((-days if sort_order == 'desc' else days) << 32) | doc_id
+
+
+def encode_cursor(days: int, doc_id: int) -> str:
+    '''
+    An opaque cursor of the position of a doc in results sorted by date, to
+    resume after it with `keys_after`.
+    '''
+    data = struct.pack('<HI', int(days), int(doc_id))
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> (int, int):
+    '''(days, doc id) of a cursor, raise ValueError if it is invalid'''
+    try:
+        return struct.unpack('<HI', base64.urlsafe_b64decode(cursor))
+    except (struct.error, ValueError, TypeError):
+        raise ValueError(f'Invalid cursor: {cursor}')
+
+
+def keys_after(keys: np.ndarray, cursor: str, sort_order: str) -> np.ndarray:
+    '''The sorted keys (see `date_keys`) after the doc of the cursor'''
+    days, doc_id = decode_cursor(cursor)
+    start = np.searchsorted(keys, date_key(days, doc_id, sort_order),
+                            side='right')
+    return keys[start:]
+
+
+def build_calendar(meta_idx: dict) -> [tuple]:
+    '''
+    The years, months and days of the metadata index as a sorted tree:
+    [(year, [(month, [day, ...]), ...]), ...], for `page_by_date`.
+    '''
+    months = {}
+    for day in sorted(meta_idx['day']):
+        months.setdefault(day[:4], {}).setdefault(day[:7], []).append(day)
+    return [(year, sorted(months[year].items())) for year in sorted(months)]
+
+
+def page_by_date(postings_list: BitMap, meta_idx: dict, calendar: [tuple],
+                 k: int, sort_order: str='desc', after: tuple=None) -> [int]:
+    '''
+    The first `k` doc ids of `sort_by_date(postings_list)` after the doc
+    `after` = (date, doc id). Docs are taken day by day from the metadata
+    index, skipping the years and months with no results or before `after`,
+    so a page costs the same however deep it is, and the results are never
+    sorted.
+    '''
+    desc = sort_order == 'desc'
+    page = []
+    start = None
+    if after is not None:
+        start, doc_id = after
+        # The rest of the day of `after`
+        same_day = postings_list & meta_idx['day'].get(start, BitMap())
+        page += islice(same_day[same_day.rank(doc_id):], k)
+
+    def todo(key: str) -> bool:
+        '''Whether the year, month or day `key` is not before `start`'''
+        if start is None:
+            return True
+        if len(key) == len(start):   # A day, the day of `start` is done
+            return key < start if desc else key > start
+        prefix = start[:len(key)]
+        return key <= prefix if desc else key >= prefix
+
+    for year, months in (reversed(calendar) if desc else calendar):
+        if len(page) >= k:
+            break
+        if not todo(year) or not postings_list.intersection_cardinality(
+                meta_idx['year'][year]):
+            continue
+        for month, days in (reversed(months) if desc else months):
+            if len(page) >= k:
+                break
+            if not todo(month) or not postings_list.intersection_cardinality(
+                    meta_idx['month'][month]):
+                continue
+            for day in (reversed(days) if desc else days):
+                if len(page) >= k:
+                    break
+                if todo(day):
+                    docs = postings_list & meta_idx['day'][day]
+                    page += islice(docs, k - len(page))
+    return page
+
+
+def sort_by_date(postings_list: BitMap, id_to_date: np.ndarray,
+                 sort_order: str='desc') -> [int]:
+    '''
+    Sort doc ids by date, filter them with `date_range_bitmap` before this.
+    `id_to_date` is the date column (see `dates.py`), or a dict of date strs.
+    '''
+    if isinstance(id_to_date, np.ndarray):
+        keys = np.sort(date_keys(postings_list, id_to_date, sort_order))
+        return (keys & 0xffffffff).tolist()
+    return sorted(postings_list, key=lambda x: id_to_date[x],
+                  reverse=sort_order == 'desc')
+
+
+def top_by_date(postings_list: BitMap, id_to_date: np.ndarray, k: int,
+                sort_order: str='desc') -> [int]:
+    '''
+    The first `k` doc ids of `sort_by_date`, without sorting all of them.
+    '''
+    if isinstance(id_to_date, np.ndarray):
+        keys = date_keys(postings_list, id_to_date, sort_order)
+        if k <= 0:
+            return []
+        if k < len(keys):
+            keys = np.partition(keys, k - 1)[:k]
+        return (np.sort(keys) & 0xffffffff).tolist()
+    select = heapq.nlargest if sort_order == 'desc' else heapq.nsmallest
+    return select(k, postings_list, key=lambda x: id_to_date[x])
+
+
+# A field-qualified clause, e.g. "column:文化", "author:xxx",
+# "date:[2003-01-01 TO 2005-12-31]", "date:2003-05".
+FIELD_CLAUSE = re.compile(
+    r'(column|author|date)\s*[:：]\s*(\[[^\]]*\]|[^\s()（）]+)', re.IGNORECASE)
+DATE_RANGE = re.compile(r'\[\s*(\S+)\s+TO\s+(\S+)\s*\]', re.IGNORECASE)
+# A fuzzy term, e.g. "经纪~" or "经纪~2", "~" alone means edit distance 1.
+FUZZY_TERM = re.compile(r'(.+)~(\d?)')
+
+
+def parse_field_clause(field: str, value: str) -> tuple:
+    '''
+    Turn a field-qualified clause into a node (see `parse_boolean_query`):
+
+        ('field', field, value)         for column and author
+        ('date', min_date, max_date)    for date, both ends are inclusive
+
+    A date is a range "[min TO max]", where "*" is an open end, or a year,
+    month or day, e.g. "2003", "2003-05".
+    '''
+    field = field.lower()
+    if field != 'date':
+        return ('field', field, value)
+    match = DATE_RANGE.fullmatch(value)
+    if match:
+        lo, hi = match.groups()
+    else:
+        lo = hi = value
+    # Expand years and months to the first and last day
+    lo = '' if lo == '*' else lo + '-01-01'[len(lo) - 4:]
+    hi = '9999-12-31' if hi == '*' else hi + '-12-31'[len(hi) - 4:]
+    return ('date', lo, hi)
+
+
+def tokenize_query(bool_expr: str) -> [str]:
+    '''
+    Split a boolean query into terms and operators ('&', '|', '!', '(', ')').
+    Field-qualified clauses are returned as nodes, see `parse_field_clause`.
+    '''
+    # Take out field clauses first, so that their values are kept as is.
+    clauses = []
+    def take_clause(match) -> str:
+        clauses.append(parse_field_clause(*match.groups()))
+        return f' \0{len(clauses) - 1}\0 '
+    bool_expr = FIELD_CLAUSE.sub(take_clause, bool_expr)
 
     # 预处理表达式：转成大写，全角转半角，操作符两端加空格
     bool_expr = bool_expr.upper()
@@ -96,32 +315,57 @@ def process_boolean_query(bool_expr: str, postings_lists: {str: BitMap},
     bool_expr = bool_expr.replace('NOT', '!')
     for op in ['&', '|', '!', '(', ')']:
         bool_expr = bool_expr.replace(op, ' ' + op + ' ')
+    tokens = bool_expr.split()
+    return [clauses[int(t[1:-1])] if t[0] == '\0' else t for t in tokens]
 
-    # print('Processed:', bool_expr)
 
-    tokens = bool_expr.split()
+def parse_term(term: str) -> tuple:
+    '''
+    The node of a term, terms with wildcards ("经济*", "?济") or ending with
+    "~" (fuzzy) are expanded into terms of the vocabulary when evaluated.
+    '''
+    match = FUZZY_TERM.fullmatch(term)
+    if match:
+        return ('fuzzy', match.group(1), int(match.group(2) or 1))
+    if '*' in term or '?' in term:
+        return ('wildcard', term)
+    return ('term', term)
+
+
+def parse_boolean_query(bool_expr: str) -> tuple:
+    '''
+    Parse a boolean query into a tree, where each node is one of:
 
-    # print('Tokens:', tokens)
+        ('term', term)
+        ('wildcard', pattern)
+        ('fuzzy', term, max_dist)
+        ('field', field, value)
+        ('date', min_date, max_date)
+        ('not', node)
+        ('and', node, node)
+        ('or', node, node)
+
+    The operands of 'and' and 'or' are sorted, so that equal sub-expressions
+    are equal tuples, e.g. "a and b" and "b and a".
+    '''
+    # 用两个栈来实现表达式解析
+    op_stack = []
+    node_stack = []
+    tokens = tokenize_query(bool_expr)
 
     def collapse_once():
-        '''Pop an operator from operator stack, pop operand sets, then execute 
-        and push the result'''
+        '''Pop an operator from operator stack, pop operand nodes, then push
+        the node of the operation'''
         op = op_stack.pop()
-        res = None
-        if op == '&':
-            a = set_stack.pop()
-            b = set_stack.pop()
-            res = a & b
-        elif op == '|':
-            a = set_stack.pop()
-            b = set_stack.pop()
-            res = a | b
+        if op == '&' or op == '|':
+            a = node_stack.pop()
+            b = node_stack.pop()
+            node = ('and' if op == '&' else 'or',) + tuple(sorted([a, b]))
         elif op == '!':
-            a = set_stack.pop()
-            res = a.flip(0, num_docs)
+            node = ('not', node_stack.pop())
         else:
             raise ValueError('Invalid operator:', op)
-        set_stack.append(res)
+        node_stack.append(node)
 
     # 高优先级会被先处理
     OP_PRIORITY = {'(': -1, '|': 0, '&': 1, '!': 2}
@@ -139,21 +383,345 @@ def process_boolean_query(bool_expr: str, postings_lists: {str: BitMap},
             while op_stack and OP_PRIORITY[op_stack[-1]] >= OP_PRIORITY[token]:
                 collapse_once()
             op_stack.append(token)
+        elif isinstance(token, tuple):
+            # token is a field clause
+            node_stack.append(token)
         else:
             # token is a term
-            if token in postings_lists:
-                set_stack.append(postings_lists[token])
-            else:
-                set_stack.append(BitMap())
+            node_stack.append(parse_term(token))
     while op_stack:
         collapse_once()
-    if len(set_stack) != 1:
+    if len(node_stack) != 1:
         raise ValueError('Invalid boolean query:', bool_expr)
-    return set_stack[-1]
+    return node_stack[-1]
+
+
+def analyze_query(node: tuple, postings_lists: {str: BitMap},
+                  segmenter) -> tuple:
+    '''
+    Rewrite the terms of a parsed query that are not in the index, e.g. an
+    unsegmented phrase, into the AND of the words `segmenter` splits them
+    into. Words not in the index (e.g. stop words) are left out.
+    '''
+    op = node[0]
+    if op == 'term':
+        if node[1] in postings_lists:
+            return node
+        words = [w for w in segmenter.cut(node[1]) if w in postings_lists]
+        if not words:
+            return node
+        res = ('term', words[0])
+        for word in words[1:]:
+            res = ('and',) + tuple(sorted([res, ('term', word)]))
+        return res
+    if op == 'not':
+        return ('not', analyze_query(node[1], postings_lists, segmenter))
+    if op in ('and', 'or'):
+        a = analyze_query(node[1], postings_lists, segmenter)
+        b = analyze_query(node[2], postings_lists, segmenter)
+        return (op,) + tuple(sorted([a, b]))
+    return node
+
+
+def date_range_bitmaps(meta_idx: dict, min_date: str=None,
+                       max_date: str=None) -> [BitMap]:
+    '''
+    Disjoint bitmaps of the metadata index whose union is the docs with dates
+    in [min_date, max_date], taking whole years and months where possible.
+    '''
+    lo = min_date or ''
+    hi = max_date or '9999-12-31'
+    bitmaps = []
+    for year, year_bitmap in meta_idx['year'].items():
+        if lo <= year + '-01-01' and year + '-12-31' <= hi:
+            bitmaps.append(year_bitmap)
+        elif lo <= year + '-12-31' and year + '-01-01' <= hi:
+            # Partly in range, take the months in this year
+            for month, month_bitmap in meta_idx['month'].items():
+                if month[:4] != year:
+                    continue
+                if lo <= month + '-01' and month + '-31' <= hi:
+                    bitmaps.append(month_bitmap)
+                elif lo <= month + '-31' and month + '-01' <= hi:
+                    # Partly in range, take the days in this month
+                    bitmaps += [b for day, b in meta_idx['day'].items()
+                                if day[:7] == month and lo <= day <= hi]
+    return bitmaps
+
+
+def date_range_bitmap(meta_idx: dict, min_date: str=None,
+                      max_date: str=None) -> BitMap:
+    '''Docs with dates in [min_date, max_date]'''
+    bitmaps = date_range_bitmaps(meta_idx, min_date, max_date)
+    return BitMap.union(*bitmaps) if bitmaps else BitMap()
+
+
+def expand_term(node: tuple, term_dict) -> [str]:
+    '''Terms of the vocabulary matched by a wildcard or fuzzy node'''
+    if node[0] == 'wildcard':
+        return term_dict.wildcard(node[1])
+    return term_dict.fuzzy(node[1], node[2])
+
+
+def get_cardinality(postings_lists: {str: BitMap}, term: str) -> int:
+    '''Number of docs of a term, without decoding compressed postings'''
+    if hasattr(postings_lists, 'cardinality'):
+        return postings_lists.cardinality(term)
+    return len(postings_lists.get(term, ()))
+
+
+def positive_terms(node: tuple, term_dict=None) -> [str]:
+    '''
+    The terms of a parsed query that are not negated, with wildcard and fuzzy
+    terms expanded, e.g. for highlighting.
+    '''
+    op = node[0]
+    if op == 'term':
+        return [node[1]]
+    if op in ('wildcard', 'fuzzy'):
+        return expand_term(node, term_dict)
+    if op in ('and', 'or'):
+        return (positive_terms(node[1], term_dict)
+                + positive_terms(node[2], term_dict))
+    return []
+
+
+def estimate_cost(node: tuple, postings_lists: {str: BitMap}, num_docs: int,
+                  meta_idx: dict=None, term_dict=None) -> (float, float):
+    '''
+    Estimate (number of results, work) of a parsed query before evaluating
+    it, from the cardinalities of the postings lists, assuming terms are
+    independent. Work is the number of docs read and written by the bitmap
+    operations, e.g. a NOT costs `num_docs`.
+    '''
+    op = node[0]
+    if op == 'term':
+        size = get_cardinality(postings_lists, node[1])
+        return size, size
+    if op in ('wildcard', 'fuzzy'):
+        sizes = [get_cardinality(postings_lists, t)
+                 for t in expand_term(node, term_dict)]
+        return min(sum(sizes), num_docs), sum(sizes)
+    if op == 'field':
+        size = len(meta_idx[node[1]].get(node[2], ()))
+        return size, size
+    if op == 'date':
+        # The bitmaps are disjoint, no need to build their union
+        size = sum(map(len, date_range_bitmaps(meta_idx, node[1], node[2])))
+        return size, size
+    args = (postings_lists, num_docs, meta_idx, term_dict)
+    if op == 'not':
+        size, work = estimate_cost(node[1], *args)
+        return num_docs - size, work + num_docs
+    size_a, work_a = estimate_cost(node[1], *args)
+    size_b, work_b = estimate_cost(node[2], *args)
+    work = work_a + work_b + size_a + size_b
+    if op == 'and':
+        return size_a * size_b / num_docs, work
+    if op == 'or':
+        return size_a + size_b - size_a * size_b / num_docs, work
+    raise ValueError('Invalid node:', node)
+
+
+def evaluate_query(node: tuple, postings_lists: {str: BitMap}, num_docs: int,
+                   cache: dict=None, meta_idx: dict=None,
+                   term_dict=None) -> BitMap:
+    '''
+    Compute the postings list of a parsed query (see `parse_boolean_query`).
+    `meta_idx` is the metadata index, needed by field clauses, and
+    `term_dict` is the `TermDict` of the vocabulary, needed by wildcard and
+    fuzzy terms, which are the union of the postings of their expansions.
+
+    `cache` maps nodes to their results, pass the same dict when evaluating
+    several queries so that shared sub-expressions are computed once. The
+    results must not be modified, they can be in the cache or the index.
+    '''
+    if cache is None:
+        cache = {}
+    if node in cache:
+        return cache[node]
+
+    op = node[0]
+    if op in ('field', 'date') and meta_idx is None:
+        raise ValueError('Field clauses need the metadata index:', node)
+    if op in ('wildcard', 'fuzzy') and term_dict is None:
+        raise ValueError('Wildcards need the term dictionary:', node)
+    if op == 'term':
+        res = postings_lists.get(node[1], BitMap())
+    elif op in ('wildcard', 'fuzzy'):
+        terms = expand_term(node, term_dict)
+        postings = [postings_lists.get(t, BitMap()) for t in terms]
+        res = BitMap.union(*postings) if postings else BitMap()
+    elif op == 'field':
+        res = meta_idx[node[1]].get(node[2], BitMap())
+    elif op == 'date':
+        res = date_range_bitmap(meta_idx, node[1], node[2])
+    elif op == 'not':
+        a = evaluate_query(node[1], postings_lists, num_docs, cache, meta_idx,
+                           term_dict)
+        res = a.flip(0, num_docs)
+    elif op == 'and':
+        a = evaluate_query(node[1], postings_lists, num_docs, cache, meta_idx,
+                           term_dict)
+        b = evaluate_query(node[2], postings_lists, num_docs, cache, meta_idx,
+                           term_dict)
+        res = a & b
+    elif op == 'or':
+        a = evaluate_query(node[1], postings_lists, num_docs, cache, meta_idx,
+                           term_dict)
+        b = evaluate_query(node[2], postings_lists, num_docs, cache, meta_idx,
+                           term_dict)
+        res = a | b
+    else:
+        raise ValueError('Invalid node:', node)
+    cache[node] = res
+    return res
 
 
-def get_sim_docs(doc_index: int, chunk_size=2**12, corpus_size=612031) -> [int]:
-    '''Return indices of documents most similar to the given document.'''
+def parse_query(bool_expr: str, postings_lists: {str: BitMap},
+                segmenter=None) -> tuple:
+    '''
+    Parse a boolean query into a tree (see `parse_boolean_query`), terms
+    not in the index are segmented with `segmenter`, if given.
+    '''
+    node = parse_boolean_query(bool_expr)
+    if segmenter is not None:
+        node = analyze_query(node, postings_lists, segmenter)
+    return node
+
+
+def query_to_str(node: tuple) -> str:
+    '''Normalized string of a parsed query, e.g. for logging'''
+    op = node[0]
+    if op == 'term':
+        return node[1]
+    if op == 'wildcard':
+        return node[1]
+    if op == 'fuzzy':
+        return f'{node[1]}~{node[2]}'
+    if op == 'field':
+        return f'{node[1]}:{node[2]}'
+    if op == 'date':
+        return f'date:[{node[1] or "*"} TO {node[2]}]'
+    if op == 'not':
+        return f'NOT {query_to_str(node[1])}'
+    return (f'({query_to_str(node[1])} {op.upper()} '
+            f'{query_to_str(node[2])})')
+
+
+def missing_terms(node: tuple, postings_lists: {str: BitMap}) -> [str]:
+    '''The terms of a parsed query that are not in the index'''
+    op = node[0]
+    if op == 'term':
+        return [] if node[1] in postings_lists else [node[1]]
+    if op == 'not':
+        return missing_terms(node[1], postings_lists)
+    if op in ('and', 'or'):
+        return (missing_terms(node[1], postings_lists)
+                + missing_terms(node[2], postings_lists))
+    return []
+
+
+def replace_terms(node: tuple, replacements: {str: str}) -> tuple:
+    '''A parsed query with some terms replaced'''
+    op = node[0]
+    if op == 'term':
+        return ('term', replacements.get(node[1], node[1]))
+    if op == 'not':
+        return ('not', replace_terms(node[1], replacements))
+    if op in ('and', 'or'):
+        return (op, replace_terms(node[1], replacements),
+                replace_terms(node[2], replacements))
+    return node
+
+
+def process_boolean_query(bool_expr: str, postings_lists: {str: BitMap}, 
+                          num_docs: int, meta_idx: dict=None,
+                          term_dict=None, segmenter=None) -> BitMap:
+    '''
+    Given a string of boolean query, compute the resulting postings list.
+    Terms not in the index are segmented with `segmenter`, if given.
+    '''
+    node = parse_query(bool_expr, postings_lists, segmenter)
+    return evaluate_query(node, postings_lists, num_docs, meta_idx=meta_idx,
+                          term_dict=term_dict)
+
+
+class QueryTooExpensive(ValueError):
+    '''The estimated work of a query (see `estimate_cost`) is over a limit'''
+    def __init__(self, size: float, work: float):
+        super().__init__(f'query too expensive: {int(work)} > limit')
+        self.size = size
+        self.work = work
+
+
+def process_boolean_queries(bool_exprs: [str], postings_lists: {str: BitMap},
+                            num_docs: int, meta_idx: dict=None,
+                            term_dict=None, segmenter=None,
+                            cache: dict=None,
+                            max_work: float=None) -> [BitMap]:
+    '''
+    Compute the postings lists of many boolean queries at once, the terms and
+    sub-expressions they share are only evaluated once. The result of an
+    invalid query is the exception raised when parsing it, and the result of
+    a query whose estimated work is more than `max_work` is a
+    `QueryTooExpensive`.
+    '''
+    if cache is None:
+        cache = {}
+    results = []
+    for bool_expr in bool_exprs:
+        try:
+            node = parse_query(bool_expr, postings_lists, segmenter)
+        except Exception as e:
+            results.append(e)
+            continue
+        if max_work is not None:
+            size, work = estimate_cost(node, postings_lists, num_docs,
+                                       meta_idx, term_dict)
+            if work > max_work:
+                results.append(QueryTooExpensive(size, work))
+                continue
+        results.append(evaluate_query(node, postings_lists, num_docs, cache,
+                                      meta_idx, term_dict))
+    return results
+
+
+def facet_counts(postings_list: BitMap, facet: {str: BitMap}) -> {str: int}:
+    '''
+    Count the docs of a postings list in each bucket of a facet of the
+    metadata index, e.g. `meta_idx['year']`, without materializing any ids.
+    '''
+    return {key: postings_list.intersection_cardinality(bitmap)
+            for key, bitmap in sorted(facet.items())}
+
+
+def collapse_similar(doc_id: int, similar: [int],
+                     dup_clusters: np.ndarray) -> [int]:
+    '''
+    Similar docs of `doc_id` with each near-duplicate replaced by the
+    canonical doc of its cluster (see `preprocess/dedup.py`), each cluster
+    once, and without `doc_id` and its duplicates.
+    '''
+    seen = {int(dup_clusters[doc_id])}
+    res = []
+    for i in similar:
+        cluster = int(dup_clusters[i])
+        if cluster not in seen:
+            seen.add(cluster)
+            res.append(cluster)
+    return res
+
+
+def get_sim_docs(doc_index: int, chunk_size=2**12, corpus_size=612031,
+                 sim_docs: np.ndarray=None) -> [int]:
+    '''
+    Return indices of documents most similar to the given document, from
+    `sim_docs` (the memory-mapped `similar_docs.npy`) if given, otherwise
+    from the pickled chunks.
+    '''
+    if sim_docs is not None:
+        return sim_docs[doc_index].tolist()
     chunk_start = doc_index // chunk_size * chunk_size
     chunk_end = min(chunk_start + chunk_size, corpus_size)
     offset = doc_index - chunk_start
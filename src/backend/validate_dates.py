@@ -0,0 +1,63 @@
+'''
+Cross-check the date column `id_to_date.npy` (see `dates.py`) against the
+dates in the Elasticsearch index `rmrb_00-15-date` on a random sample of doc
+ids. Exits with status 1 if any date differs or is missing.
+
+Usage (in `src/backend`): python validate_dates.py --sample 10000
+'''
+import sys
+import random
+import argparse
+
+from elasticsearch import Elasticsearch
+
+import dates
+
+es_index_date = 'rmrb_00-15-date'
+file_id_to_date = '../../data/id_to_date.npy'
+BATCH_SIZE = 1000
+
+
+def fetch_dates(es: Elasticsearch, ids: [int]) -> {int: str}:
+    '''{doc id: date} of the docs found in the date index'''
+    res = es.mget(index=es_index_date, body={'ids': ids})
+    return {int(doc['_id']): doc['_source']['date']
+            for doc in res['docs'] if doc['found']}
+
+
+def validate(column, ids: [int], es: Elasticsearch) -> [tuple]:
+    '''Return (doc id, date in the column, date in ES) of each mismatch'''
+    mismatches = []
+    for i in range(0, len(ids), BATCH_SIZE):
+        batch = ids[i:i + BATCH_SIZE]
+        es_dates = fetch_dates(es, batch)
+        for doc_id in batch:
+            date = dates.days_to_date(column[doc_id])
+            if es_dates.get(doc_id) != date:
+                mismatches.append((doc_id, date, es_dates.get(doc_id)))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sample', type=int, default=10000,
+                        help='Number of random doc ids to check')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--file', default=file_id_to_date)
+    args = parser.parse_args()
+
+    column = dates.load_dates(args.file)
+    num_docs = len(column)
+    rng = random.Random(args.seed)
+    ids = sorted(rng.sample(range(num_docs), min(args.sample, num_docs)))
+    print(f'Checking {len(ids)} of {num_docs} dates against {es_index_date}...')
+    mismatches = validate(column, ids, Elasticsearch())
+    for doc_id, date, es_date in mismatches[:20]:
+        print(f'  doc {doc_id}: {date} in the column, {es_date} in ES')
+    print(f'{len(mismatches)} mismatches')
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
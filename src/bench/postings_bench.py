@@ -0,0 +1,112 @@
+'''
+Benchmark of the postings codecs (see `backend/postings.py`) on the terms of
+the real inverted index: size, load time and throughput of AND, OR and
+AND NOT of two postings lists, including decoding them.
+
+Run in `src` after the `inv_idx` preprocessing stage:
+
+    python -m bench.postings_bench --num-pairs 2000
+'''
+import time
+import argparse
+import tempfile
+import pickle as pkl
+from pathlib import Path
+
+import numpy as np
+
+from backend.postings import CODECS, PostingsIndex
+
+OPS = {
+    'and': lambda a, b: a & b,
+    'or': lambda a, b: a | b,
+    'andnot': lambda a, b: a - b,
+}
+
+
+def sample_pairs(inv_idx: dict, num_pairs: int, seed: int=0) -> [(str, str)]:
+    '''
+    Random pairs of terms, each term is drawn with probability proportional
+    to its doc freq., since frequent terms are also queried more often.
+    '''
+    terms = list(inv_idx)
+    doc_freq = np.array([len(inv_idx[t]) for t in terms], dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    idx = rng.choice(len(terms), size=(num_pairs, 2), p=doc_freq / doc_freq.sum())
+    return [(terms[i], terms[j]) for i, j in idx]
+
+
+def bench_index(index, pairs: [(str, str)]) -> {str: float}:
+    '''Operations per second of each op, looking up both lists every time'''
+    res = {}
+    for name, op in OPS.items():
+        start_time = time.perf_counter()
+        for a, b in pairs:
+            op(index[a], index[b])
+        res[name] = len(pairs) / (time.perf_counter() - start_time)
+    return res
+
+
+def bench_load(file: Path, load) -> float:
+    start_time = time.perf_counter()
+    load(file)
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inv-idx', default='../data/inv_idx_roaring.pkl')
+    parser.add_argument('--num-pairs', type=int, default=2000)
+    parser.add_argument('--dense-thresholds', type=float, nargs='*',
+                        default=[1 / 256, 1 / 4096, 1 / 65536],
+                        help='Thresholds of density for using roaring')
+    args = parser.parse_args()
+
+    print(f'Loading {args.inv_idx}...')
+    with open(args.inv_idx, 'rb') as f:
+        inv_idx = pkl.load(f)
+    universe = max(b.max() for b in inv_idx.values() if b) + 1
+    pairs = sample_pairs(inv_idx, args.num_pairs)
+    print(f'{len(inv_idx)} terms, {universe} docs, {len(pairs)} pairs')
+
+    def load_pickle(file):
+        with open(file, 'rb') as f:
+            return pkl.load(f)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The current format, a pickle of {term: BitMap}
+        file = Path(tmp_dir, 'pickle.pkl')
+        with open(file, 'wb') as f:
+            pkl.dump(inv_idx, f)
+        rows.append(('pickled BitMap', file.stat().st_size,
+                     bench_load(file, load_pickle), bench_index(inv_idx, pairs)))
+
+        configs = [(codec, codec, None) for codec in CODECS]
+        configs += [(f'density>=1/{1 / t:.0f}', None, t)
+                    for t in args.dense_thresholds]
+        for name, codec, threshold in configs:
+            start_time = time.perf_counter()
+            if threshold is None:
+                index = PostingsIndex.build(inv_idx, universe, codec)
+            else:
+                index = PostingsIndex.build(inv_idx, universe,
+                                            dense_threshold=threshold)
+            print(f'Encoded with {name} in {time.perf_counter() - start_time:.2f}s',
+                  index.codec_counts())
+            file = Path(tmp_dir, f'{len(rows)}.pkl')
+            index.save(file)
+            rows.append((name, file.stat().st_size,
+                         bench_load(file, PostingsIndex.load),
+                         bench_index(index, pairs)))
+
+    print()
+    print(f'{"codec":<18}{"size (MB)":>12}{"load (s)":>10}'
+          + ''.join(f'{op + " (op/s)":>16}' for op in OPS))
+    for name, size, load_time, throughput in rows:
+        print(f'{name:<18}{size / 2**20:>12.2f}{load_time:>10.3f}'
+              + ''.join(f'{throughput[op]:>16.0f}' for op in OPS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''
+Report the effect of reordering doc ids (see `preprocess/reorder.py`) on
+the inverted index: size of the roaring and packed indexes, containers by
+type, and throughput of AND, OR and AND NOT.
+
+Build the index in the original order, then compute the new order, and
+compare them, in `src`:
+
+    python preprocess.py inv_idx
+    python preprocess.py reorder --reorder column_date
+    python -m bench.reorder_bench --id-map ../data/id_map.npy
+'''
+import argparse
+import pickle as pkl
+
+import numpy as np
+
+from backend.postings import PostingsIndex, to_bitmap
+from bench.postings_bench import sample_pairs, bench_index
+
+CONTAINER_TYPES = ['array', 'run', 'bitset']
+
+
+def remap_index(inv_idx: dict, id_map: np.ndarray) -> dict:
+    '''The index with new ids, where `id_map[new_id] = old_id`'''
+    old_to_new = np.empty(len(id_map), dtype=np.uint32)
+    old_to_new[id_map] = np.arange(len(id_map), dtype=np.uint32)
+    res = {}
+    for term, bitmap in inv_idx.items():
+        ids = np.frombuffer(bitmap.to_array(), dtype=np.uint32)
+        res[term] = to_bitmap(np.sort(old_to_new[ids]))
+        res[term].run_optimize()
+    return res
+
+
+def index_stats(inv_idx: dict, universe: int) -> dict:
+    stats = {'roaring_bytes': 0, 'packed_bytes': 0}
+    stats.update({f'{t}_containers': 0 for t in CONTAINER_TYPES})
+    for bitmap in inv_idx.values():
+        bitmap.run_optimize()
+        stats['roaring_bytes'] += len(bitmap.serialize())
+        s = bitmap.get_statistics()
+        for t in CONTAINER_TYPES:
+            stats[f'{t}_containers'] += s[f'n_{t}_containers']
+    stats['packed_bytes'] = PostingsIndex.build(inv_idx, universe).nbytes()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inv-idx', default='../data/inv_idx_roaring.pkl',
+                        help='Index with the original ids')
+    parser.add_argument('--id-map', default='../data/id_map.npy')
+    parser.add_argument('--num-pairs', type=int, default=2000)
+    args = parser.parse_args()
+
+    with open(args.inv_idx, 'rb') as f:
+        before = pkl.load(f)
+    id_map = np.load(args.id_map)
+    after = remap_index(before, id_map)
+    pairs = sample_pairs(before, args.num_pairs)
+
+    results = {}
+    for name, inv_idx in [('before', before), ('after', after)]:
+        results[name] = index_stats(inv_idx, len(id_map))
+        for op, ops_per_sec in bench_index(inv_idx, pairs).items():
+            results[name][f'{op} (op/s)'] = ops_per_sec
+
+    print(f'{"":<22}{"before":>14}{"after":>14}{"change":>10}')
+    for key in results['before']:
+        a, b = results['before'][key], results['after'][key]
+        change = f'{(b - a) / a:+.1%}' if a else ''
+        print(f'{key:<22}{a:>14.0f}{b:>14.0f}{change:>10}')
+
+
+if __name__ == '__main__':
+    main()
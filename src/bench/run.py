@@ -0,0 +1,183 @@
+'''
+End-to-end benchmark of the query path of `/search` on a synthetic corpus:
+evaluating the boolean query, filtering by date, sorting by date and paging,
+without Elasticsearch. Reports latency percentiles (total and by stage) and
+throughput, and compares them with a saved JSON baseline.
+
+Run in `src`, e.g.:
+
+    python -m bench.run --scale 1m --save-baseline
+    (change some code)
+    python -m bench.run --scale 1m
+
+which exits with status 1 if a metric is worse than the baseline by more
+than `--tolerance`.
+'''
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+from backend import utils
+from bench.synthetic import SCALES, gen_corpus
+from bench.workload import gen_workload, save_workload, load_workload
+
+BASELINE_DIR = Path(__file__).resolve().parent / 'baselines'
+STAGES = ['evaluate', 'filter', 'sort', 'page']
+PERCENTILES = [50, 90, 99]
+# Metrics compared with the baseline, and whether higher is better
+COMPARED = {'p50_ms': False, 'p90_ms': False, 'p99_ms': False, 'qps': True}
+
+
+def run_query(query: dict, corpus: dict) -> ({str: float}, int):
+    '''Run a query like `/search`, return (time of each stage, total hits)'''
+    t0 = time.perf_counter()
+    postings_list = utils.process_boolean_query(
+        query['query'], corpus['inv_idx'], corpus['num_docs'],
+        corpus['meta_idx'])
+    t1 = time.perf_counter()
+    if 'min_date' in query or 'max_date' in query:
+        postings_list = postings_list & utils.date_range_bitmap(
+            corpus['meta_idx'], query.get('min_date'), query.get('max_date'))
+    t2 = time.perf_counter()
+    ids = utils.sort_by_date(postings_list, corpus['id_to_date'],
+                             query['sort_order'])
+    t3 = time.perf_counter()
+    ids[query['min_index']:query['max_index']]
+    t4 = time.perf_counter()
+    times = dict(zip(STAGES, [t1 - t0, t2 - t1, t3 - t2, t4 - t3]))
+    return times, len(ids)
+
+
+def summarize(latencies: [float]) -> dict:
+    '''Percentiles and mean of latencies in seconds, in ms'''
+    arr = np.array(latencies) * 1000
+    res = {f'p{p}_ms': float(np.percentile(arr, p)) for p in PERCENTILES}
+    res['max_ms'] = float(arr.max())
+    res['mean_ms'] = float(arr.mean())
+    return res
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_workload(queries: [dict], corpus: dict, warm_up: int) -> dict:
+    for query in queries[:warm_up]:
+        run_query(query, corpus)
+
+    totals = []
+    stage_times = {s: [] for s in STAGES}
+    by_kind = {}
+    start_time = time.perf_counter()
+    for query in queries:
+        times, _ = run_query(query, corpus)
+        total = sum(times.values())
+        totals.append(total)
+        for s in STAGES:
+            stage_times[s].append(times[s])
+        by_kind.setdefault(query['kind'], []).append(total)
+    elapsed = time.perf_counter() - start_time
+
+    result = summarize(totals)
+    result['qps'] = len(queries) / elapsed
+    result['stages'] = {s: summarize(stage_times[s]) for s in STAGES}
+    result['by_kind'] = {k: dict(summarize(v), count=len(v))
+                         for k, v in sorted(by_kind.items())}
+    return result
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> [str]:
+    '''Return the metrics that are worse than the baseline'''
+    regressions = []
+    print(f'{"metric":<10}{"baseline":>12}{"current":>12}{"change":>10}')
+    for metric, higher_is_better in COMPARED.items():
+        old, new = baseline[metric], result[metric]
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = '  REGRESSION' if worse > tolerance else ''
+        print(f'{metric:<10}{old:>12.3f}{new:>12.3f}{change:>+10.1%}{flag}')
+        if flag:
+            regressions.append(metric)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', choices=SCALES, default='100k')
+    parser.add_argument('--num-queries', type=int, default=2000)
+    parser.add_argument('--warm-up', type=int, default=100,
+                        help='Number of queries to run before measuring')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workload', type=Path,
+                        help='Load the workload from this jsonl file if it '
+                             'exists, otherwise save the generated one to it')
+    parser.add_argument('--baseline', type=Path,
+                        help='Default: bench/baselines/<scale>.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--output', type=Path, help='Save the result as JSON')
+    args = parser.parse_args()
+
+    corpus = gen_corpus(SCALES[args.scale], seed=args.seed)
+    if args.workload and args.workload.exists():
+        queries = load_workload(args.workload)
+    else:
+        queries = gen_workload(list(corpus['inv_idx']),
+                               list(corpus['meta_idx']['column']),
+                               args.num_queries, args.seed)
+        if args.workload:
+            save_workload(queries, args.workload)
+
+    print(f'Running {len(queries)} queries...')
+    result = run_workload(queries, corpus, args.warm_up)
+    result.update({
+        'scale': args.scale,
+        'num_docs': corpus['num_docs'],
+        'num_queries': len(queries),
+        'seed': args.seed,
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    })
+
+    print(f'Throughput: {result["qps"]:.1f} queries/s')
+    print(f'{"":<28}' + ''.join(f'{f"p{p} (ms)":>11}' for p in PERCENTILES)
+          + f'{"max (ms)":>11}')
+    rows = [('total', result)] + list(result['stages'].items()) \
+        + [(f'{k} ({v["count"]})', v) for k, v in result['by_kind'].items()]
+    for name, r in rows:
+        print(f'{name:<28}' + ''.join(f'{r[f"p{p}_ms"]:>11.3f}'
+                                      for p in PERCENTILES)
+              + f'{r["max_ms"]:>11.3f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    baseline_file = args.baseline or BASELINE_DIR / f'{args.scale}.json'
+    if args.save_baseline:
+        baseline_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_file, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f'Saved baseline to {baseline_file}')
+    elif baseline_file.exists():
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+        print(f'Comparing with baseline of commit {baseline.get("commit")} '
+              f'({baseline.get("time")}):')
+        if compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''
+Synthetic corpora for benchmarks: the inverted index, metadata index and
+dates of a corpus whose term doc. freqs follow Zipf's law, like a real one.
+
+Only what the query path needs is generated (no text), so a corpus of 10M
+docs takes about a minute and a few GB of memory.
+'''
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+from backend.postings import to_bitmap
+from backend.dates import EPOCH
+
+SCALES = {
+    '100k': 100_000,
+    '1m': 1_000_000,
+    '10m': 10_000_000,
+}
+FIRST_DATE = date(2000, 1, 1)
+LAST_DATE = date(2015, 12, 31)
+NUM_COLUMNS = 50
+
+
+def term_name(i: int) -> str:
+    '''A term made of CJK chars, so that queries are parsed like real ones'''
+    chars = []
+    while True:
+        chars.append(chr(0x4e00 + i % 20000))
+        i //= 20000
+        if i == 0:
+            return ''.join(chars)
+
+
+def zipf_doc_freqs(num_docs: int, vocab_size: int, s: float,
+                   max_df: float) -> np.ndarray:
+    '''Doc freq. of the term of each rank, the most frequent is in `max_df`
+    of the docs'''
+    ranks = np.arange(1, vocab_size + 1)
+    return np.maximum((max_df * num_docs / ranks ** s).astype(np.int64), 1)
+
+
+def group_ids(keys: np.ndarray, names: [str]) -> {str: 'BitMap'}:
+    '''{names[k]: ids of the docs with key k}'''
+    order = np.argsort(keys, kind='stable')
+    bounds = np.searchsorted(keys[order], np.arange(len(names) + 1))
+    return {names[k]: to_bitmap(order[bounds[k]:bounds[k + 1]])
+            for k in range(len(names)) if bounds[k] < bounds[k + 1]}
+
+
+def gen_corpus(num_docs: int, vocab_size: int=20000, s: float=1.0,
+               max_df: float=0.5, seed: int=0) -> dict:
+    '''
+    Generate a corpus, return a dict of:
+
+        inv_idx: {term: BitMap}, terms are in order of decreasing doc freq.
+        meta_idx: {field: {key: BitMap}}, like `meta_idx_roaring.pkl`.
+        id_to_date: np.ndarray, the date column (see `backend/dates.py`),
+            docs are in chronological order like the real corpus.
+        num_docs: int
+    '''
+    start_time = time.time()
+    rng = np.random.default_rng(seed)
+
+    inv_idx = {}
+    for rank, df in enumerate(zipf_doc_freqs(num_docs, vocab_size, s, max_df)):
+        if df * 8 > num_docs:
+            ids = np.flatnonzero(rng.random(num_docs) < df / num_docs)
+        else:
+            ids = np.unique(rng.integers(0, num_docs, df))
+        bitmap = to_bitmap(ids)
+        bitmap.run_optimize()
+        inv_idx[term_name(rank)] = bitmap
+
+    # Dates in chronological order, columns with Zipf sizes
+    num_days = (LAST_DATE - FIRST_DATE).days + 1
+    days = np.sort(rng.integers(0, num_days, num_docs))
+    dates = [(FIRST_DATE + timedelta(days=int(d))).isoformat()
+             for d in range(num_days)]
+    id_to_date = (days + (FIRST_DATE - EPOCH).days).astype(np.uint16)
+    column_p = 1 / np.arange(1, NUM_COLUMNS + 1)
+    columns = rng.choice(NUM_COLUMNS, num_docs, p=column_p / column_p.sum())
+
+    # Month and year of each day
+    months = sorted({d[:7] for d in dates})
+    years = sorted({d[:4] for d in dates})
+    month_keys = np.array([months.index(d[:7]) for d in dates])
+    year_keys = np.array([years.index(d[:4]) for d in dates])
+    meta_idx = {
+        'day': group_ids(days, dates),
+        'month': group_ids(month_keys[days], months),
+        'year': group_ids(year_keys[days], years),
+        'column': group_ids(columns, [f'栏目{i}' for i in range(NUM_COLUMNS)]),
+    }
+    print(f'Generated a corpus of {num_docs} docs and {len(inv_idx)} terms in '
+          f'{time.time() - start_time:.1f}s')
+    return {
+        'inv_idx': inv_idx,
+        'meta_idx': meta_idx,
+        'id_to_date': id_to_date,
+        'num_docs': num_docs,
+    }
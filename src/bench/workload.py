@@ -0,0 +1,77 @@
+'''
+A replayable query workload: random boolean queries over the terms of a
+corpus (see `synthetic.py`), mixing the depth of AND/OR/NOT, the rarity of
+terms, column and date filters, and paging. The same seed and corpus give
+the same workload, which can also be saved and loaded as jsonl.
+'''
+import json
+import random
+from pathlib import Path
+
+# Terms by rank of doc freq.
+RARITY_RANKS = {
+    'common': (0, 100),
+    'medium': (100, 2000),
+    'rare': (2000, None),
+}
+PAGE_SIZE = 20
+
+
+def random_term(rng: random.Random, terms: [str], rarity: str) -> str:
+    lo, hi = RARITY_RANKS[rarity]
+    return terms[rng.randrange(lo, min(hi or len(terms), len(terms)))]
+
+
+def random_expr(rng: random.Random, terms: [str], depth: int,
+                rarity: str) -> str:
+    '''A boolean expression of at most `depth` levels of operators'''
+    if depth == 0:
+        return random_term(rng, terms, rarity)
+    a = random_expr(rng, terms, rng.randrange(depth), rarity)
+    b = random_expr(rng, terms, depth - 1, rarity)
+    op = rng.choice(['AND', 'AND', 'OR', 'AND NOT'])
+    return f'({a} {op} {b})'
+
+
+def gen_workload(terms: [str], columns: [str], num_queries: int,
+                 seed: int=0) -> [dict]:
+    '''
+    Generate queries, `terms` must be in order of decreasing doc freq. Each
+    query is a dict of the parameters of `/search`, and its "kind", e.g.
+    "d2-rare-date" is a query of depth 2 of rare terms with a date range.
+    '''
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(num_queries):
+        depth = rng.choice([0, 1, 1, 2, 2, 3])
+        rarity = rng.choice(list(RARITY_RANKS))
+        expr = random_expr(rng, terms, depth, rarity)
+        kind = [f'd{depth}', rarity]
+        if rng.random() < 0.1:
+            expr = f'{expr} AND column:{rng.choice(columns)}'
+            kind.append('column')
+        query = {'query': expr, 'sort_order': rng.choice(['desc', 'asc'])}
+        if rng.random() < 0.3:
+            start_year = rng.randrange(2000, 2016)
+            end_year = min(start_year + rng.choice([0, 0, 1, 4]), 2015)
+            query['min_date'] = f'{start_year}-{rng.randrange(1, 13):02d}-01'
+            query['max_date'] = f'{end_year}-12-31'
+            kind.append('date')
+        # Mostly the first page
+        page = min(int(rng.expovariate(1.0)), 50)
+        query['min_index'] = page * PAGE_SIZE
+        query['max_index'] = (page + 1) * PAGE_SIZE
+        query['kind'] = '-'.join(kind)
+        queries.append(query)
+    return queries
+
+
+def save_workload(queries: [dict], file: Path) -> None:
+    with open(file, 'w', encoding='utf8') as f:
+        for query in queries:
+            f.write(json.dumps(query, ensure_ascii=False) + '\n')
+
+
+def load_workload(file: Path) -> [dict]:
+    with open(file, 'r', encoding='utf8') as f:
+        return [json.loads(line) for line in f]
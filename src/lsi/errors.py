@@ -0,0 +1,81 @@
+'''
+Reconstruction errors of low-rank approximations, computed without ever
+materializing the dense product U @ diag(sigma) @ V.T.
+
+All functions take a list of k and return the error of the rank-k
+approximation for each k, from a single factorization whose components are
+ordered by descending importance.
+'''
+import numpy as np
+from scipy import sparse
+
+
+def _sq_sum(block) -> float:
+    '''Sum of squares of all elements of a dense or sparse matrix.'''
+    if sparse.issparse(block):
+        data = np.asarray(block.data, dtype=np.float64)
+    else:
+        data = np.asarray(block, dtype=np.float64).ravel()
+    return data.dot(data)
+
+
+def sq_norm(mat, block_size=2**14) -> float:
+    '''Square of the Frobenius norm of `mat`, computed in blocks of rows.'''
+    if hasattr(mat, 'sq_norm'):
+        # `MemmapCSR` can do it without building the blocks.
+        return mat.sq_norm()
+    s = 0.0
+    for start in range(0, mat.shape[0], block_size):
+        s += _sq_sum(mat[start:start + block_size])
+    return s
+
+
+def svd_errors(sq_norm: float, sigma: np.ndarray, list_k: [int]) -> [float]:
+    '''
+    Frobenius norm of A - U_k S_k V_k^T for every k in `list_k`, where the
+    factors are the (truncated) SVD of A, given ||A||^2 and the singular
+    values in descending order:
+
+        ||A - U_k S_k V_k^T||^2 = ||A||^2 - sum(sigma[:k] ** 2)
+
+    This only holds for SVD factors, use `lowrank_errors` for others.
+    '''
+    sq_sigma = np.cumsum(np.asarray(sigma, dtype=np.float64) ** 2)
+    return [max(sq_norm - sq_sigma[k - 1], 0) ** 0.5 for k in list_k]
+
+
+def lowrank_errors(mat, U: np.ndarray, sigma: np.ndarray, V: np.ndarray,
+                   list_k: [int], block_size=2**14) -> [float]:
+    '''
+    Frobenius norm of A - U_k S_k V_k^T for every k in `list_k`, for any
+    low-rank factors (not necessarily orthogonal), by expanding:
+
+        ||A - B||^2 = ||A||^2 - 2 tr(A^T B) + ||B||^2
+
+    where, with u_i and v_i the i-th columns of U and V,
+
+        tr(A^T B) = sum_i sigma_i u_i^T A v_i
+        ||B||^2   = sum_ij sigma_i sigma_j (U^T U)_ij (V^T V)_ij
+
+    Takes one pass over `mat` in blocks of `block_size` rows.
+    '''
+    U = np.asarray(U, dtype=np.float64)
+    V = np.asarray(V, dtype=np.float64)
+    sigma = np.asarray(sigma, dtype=np.float64)
+
+    sq_a = 0.0
+    u_a_v = np.zeros(len(sigma))    # u_i^T A v_i for each component
+    for start in range(0, mat.shape[0], block_size):
+        block = mat[start:start + block_size]
+        sq_a += _sq_sum(block)
+        u_a_v += np.einsum('ij,ij->j', U[start:start + block_size], block @ V)
+    trace = np.cumsum(sigma * u_a_v)
+
+    gram = (U.T @ U) * (V.T @ V) * np.outer(sigma, sigma)
+    sq_b = gram.cumsum(axis=0).cumsum(axis=1).diagonal()
+
+    errors = []
+    for k in list_k:
+        sq_err = sq_a - 2 * trace[k - 1] + sq_b[k - 1]
+        errors.append(max(sq_err, 0) ** 0.5)
+    return errors
@@ -1,17 +1,64 @@
+import json
+from pathlib import Path
+
 import numpy as np
-import scipy as sp
+from scipy.sparse import csr_matrix
 from sklearn.utils.extmath import randomized_svd
 
 
-def frobenius(a, b) -> float:
+class MemmapCSR:
+    '''
+    A read-only CSR matrix whose arrays are memory-mapped from the files written
+    by `preprocess/tfidf.py:build_sparse_tfidf`. Only supports slicing rows,
+    which returns an in-memory `csr_matrix` of those rows.
+    '''
+    def __init__(self, mat_dir: Path):
+        mat_dir = Path(mat_dir)
+        with open(mat_dir / 'meta.json', 'r') as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.nnz = meta['nnz']
+        self.data = np.memmap(mat_dir / 'data.bin', dtype=np.float32, mode='r')
+        self.indices = np.memmap(mat_dir / 'indices.bin', dtype=np.int32,
+                                 mode='r')
+        self.indptr = np.memmap(mat_dir / 'indptr.bin', dtype=np.int64,
+                                mode='r')
+
+    def __getitem__(self, rows: slice) -> csr_matrix:
+        start, end, _ = rows.indices(self.shape[0])
+        lo, hi = self.indptr[start], self.indptr[end]
+        return csr_matrix(
+            (np.array(self.data[lo:hi]), np.array(self.indices[lo:hi]),
+             np.array(self.indptr[start:end + 1]) - lo),
+            shape=(end - start, self.shape[1]))
+
+    def sq_norm(self, chunk_size=2**24) -> float:
+        '''Square of the Frobenius norm, computed chunk by chunk.'''
+        s = 0.0
+        for start in range(0, self.nnz, chunk_size):
+            chunk = np.array(self.data[start:start + chunk_size],
+                             dtype=np.float64)
+            s += chunk.dot(chunk)
+        return s
+
+
+def iter_row_blocks(mat, block_size: int):
+    '''Yield (start, end, rows) for each block of `block_size` rows.'''
+    for start in range(0, mat.shape[0], block_size):
+        end = min(start + block_size, mat.shape[0])
+        yield start, end, mat[start:end]
+
+
+def frobenius(a, b, block_size=2**12) -> float:
     '''
-    Frobenius norm of the difference of two matrices.
+    Frobenius norm of the difference of two matrices, computed in blocks of
+    rows. See `errors.py` for errors of low-rank approximations that never
+    build `b`.
     '''
-    s = 0
-    for i in range(a.shape[0]):
-        d = a[i] - b[i]
-        d = np.array(d).squeeze()
-        s += d.dot(d)
+    s = 0.0
+    for start, end, block in iter_row_blocks(a, block_size):
+        d = np.asarray(block - b[start:end], dtype=np.float64)
+        s += np.einsum('ij,ij->', d, d)
     return s ** 0.5
 
 
@@ -21,31 +68,90 @@ def lsi(mat, n_components: int) -> (np.ndarray, np.ndarray, np.ndarray):
     mat: scipy.sparse.csr_matrix
     '''
     U, Sigma, VT = randomized_svd(
-        mat, 
+        mat,
         n_components=n_components,
         n_iter=5,
         random_state=0)
     return U, Sigma, VT.T
 
 
+def chunked_lsi(mat, n_components: int, n_oversamples=10, n_iter=5,
+                block_size=2**14, random_state=0) -> (np.ndarray, np.ndarray,
+                                                      np.ndarray):
+    '''
+    Out-of-core version of `lsi`, return (U, Sigma, V).
+
+    Randomized SVD (Halko et al.) where the matrix is only ever accessed by
+    streaming through blocks of `block_size` rows, so `mat` can be a
+    `MemmapCSR` that does not fit in memory. Only the factors (and a few
+    matrices of the same size) are kept in memory.
+
+    Each power iteration takes two passes over `mat`.
+    '''
+    m, n = mat.shape
+    size = n_components + n_oversamples
+
+    def matmul(x: np.ndarray) -> np.ndarray:
+        '''mat @ x'''
+        y = np.empty((m, x.shape[1]), dtype=np.float32)
+        for start, end, block in iter_row_blocks(mat, block_size):
+            y[start:end] = block @ x
+        return y
+
+    def rmatmul(y: np.ndarray) -> np.ndarray:
+        '''mat.T @ y'''
+        z = np.zeros((n, y.shape[1]), dtype=np.float32)
+        for start, end, block in iter_row_blocks(mat, block_size):
+            z += block.T @ y[start:end]
+        return z
+
+    rng = np.random.RandomState(random_state)
+    omega = rng.normal(size=(n, size)).astype(np.float32)
+    Q, _ = np.linalg.qr(matmul(omega))
+    for i in range(n_iter):
+        print(f'Power iteration {i + 1}/{n_iter}')
+        Q, _ = np.linalg.qr(rmatmul(Q))
+        Q, _ = np.linalg.qr(matmul(Q))
+
+    # B = Q.T @ mat is small (size x n), but computed through its transpose so
+    # that `mat` is still only read by rows.
+    BT = rmatmul(Q)
+    W, Sigma, XT = np.linalg.svd(BT, full_matrices=False)
+    U = Q @ XT.T
+    return U[:, :n_components], Sigma[:n_components], W[:, :n_components]
+
+
+def truncate(U: np.ndarray, sigma: np.ndarray, V: np.ndarray,
+             n_components: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    '''Get the LSI result with fewer components from a larger one.'''
+    return U[:, :n_components], sigma[:n_components], V[:, :n_components]
+
+
 def main():
+    from errors import svd_errors, lowrank_errors
+
     # Plot the approximation error of LSI for different number of components.
-    file_tfidf = '../../data/tfidf_sparse.npz'
+    data_dir = Path('../../data')
+    dir_tfidf = data_dir / 'tfidf_csr'
 
     print('Loading tfidf...')
-    tfidf = sp.sparse.load_npz(file_tfidf)
+    # (docs x vocab) TF-IDF of the whole corpus, memory-mapped.
+    tfidf = MemmapCSR(dir_tfidf)
     import matplotlib.pyplot as plt
-    diffs = []
     list_k = [1, 5, 10, 20, 50, 100, 200, 500]
-    for n_components in list_k:
-        print(f'Fitting LSI with {n_components} components...')
-        U, sigma, V = lsi(tfidf, n_components)
 
-        # print(U.shape, sigma.shape, V.shape)
-        restored = U @ np.diag(sigma) @ V.T
-        diff = frobenius(tfidf, restored)
-        print('Difference with original:', diff)
-        diffs.append(diff)
+    # Fit once with the largest k, every smaller k is a truncation of it.
+    print(f'Fitting LSI with {max(list_k)} components...')
+    doc_topic, sigma, term_topic = chunked_lsi(tfidf, max(list_k))
+    np.savez(data_dir / f'lsi_{max(list_k)}.npz', doc_topic=doc_topic,
+             sigma=sigma, term_topic=term_topic)
+
+    diffs = svd_errors(tfidf.sq_norm(), sigma, list_k)
+    # Sanity check of the factors, exact errors in one pass over the matrix.
+    checks = lowrank_errors(tfidf, doc_topic, sigma, term_topic, list_k)
+    for n_components, diff, check in zip(list_k, diffs, checks):
+        print(f'Difference with original (k = {n_components}):', diff,
+              f'(computed from factors: {check})')
 
     plt.plot(list_k, diffs)
     plt.xlabel('k')
@@ -55,4 +161,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,25 +1,64 @@
 # coding: utf8
+import os
+import sys
 import time
 import json
+import argparse
+from functools import partial
+from multiprocessing import Pool
 import pickle as pkl
 from pathlib import Path
 
+import numpy as np
 from tqdm import tqdm
 from elasticsearch import Elasticsearch
 from pyroaring import BitMap
 
-from preprocess.file_utils import jsonl_loader, load_txt_line
+from preprocess.file_utils import (jsonl_loader, jsonl_range_loader, load_txt_line,
+                                   split_byte_ranges)
 from preprocess.utils import split_tokens, format_doc
 from preprocess.vocab_building import build_vocab
+from preprocess.stats import gen_stats
+from preprocess.pipeline import Stage, Pipeline
+from preprocess.reorder import reorder_docs, ORDERS
+from preprocess.token_store import build_token_store
+from preprocess.dedup import build_dup_clusters
+from backend.postings import PostingsIndex, MmapPostings
+from backend.dates import date_to_days, save_dates
 
 
 NUM_DOCS = 612031
 
 
-def build_inv_idx(data_dir: Path, es_index: str) -> {str: [int]}:
-    '''Loop through all docs and build an inverted index
+def get_meta_keys(doc: dict) -> {str: str}:
+    '''The key of a doc in each field of the metadata index'''
+    return {
+        'year': doc['date'][:4],
+        'month': doc['date'][:7],
+        'day': doc['date'],
+        'column': doc['column'].strip(),
+        'author': doc['author'].strip(),
+    }
+
+
+def build_inv_idx(data_dir: Path, docs_file: Path=None) -> {str: [int]}:
+    '''Loop through all docs (default: `docs.jsonl` in `data_dir`) and build
+    an inverted index of terms in the vocab
     
     inverted_index: {str: [int]}, key is term, value is a list of doc ids
+
+    Saved as run-optimized roaring bitmaps to `inv_idx_roaring.pkl` and to
+    the memory-mapped `inv_idx_roaring.bin`, and to `inv_idx_packed.pkl` with
+    the codec of each term chosen by its density (see `backend/postings.py`).
+
+    In the same pass, build a metadata index, which is saved to
+    `meta_idx_roaring.pkl`:
+
+    meta_index: {str: {str: BitMap}}, the field (see `get_meta_keys`) and its
+        value, e.g. meta_idx['year']['2003'] are the ids of docs in 2003.
+
+    and the date column `id_to_date.npy`: the date of each doc as uint16 days
+    since 1970-01-01 (see `backend/dates.py`).
     '''
 
     def build_token_to_id(vocab: [str]) -> {str: int}:
@@ -32,56 +71,77 @@ def build_inv_idx(data_dir: Path, es_index: str) -> {str: [int]}:
         return token_to_id
 
 
-    file = data_dir / 'docs.jsonl'
+    file = docs_file or data_dir / 'docs.jsonl'
     file_token_to_id = data_dir / 'token_to_id.json'
     file_inv_idx_roaring = data_dir / 'inv_idx_roaring.pkl'
-    file_inv_idx = data_dir / 'inv_idx.pkl'
+    file_inv_idx_mmap = data_dir / 'inv_idx_roaring.bin'
+    file_inv_idx_packed = data_dir / 'inv_idx_packed.pkl'
+    file_meta_idx = data_dir / 'meta_idx_roaring.pkl'
+    file_id_to_date = data_dir / 'id_to_date.npy'
     
     loader = jsonl_loader(file)
 
     # Load vocab
-    vocab = build_vocab(data_dir)
-
-    if file_token_to_id.exists():
-        token_to_id = json.load(open(file_token_to_id, 'r', encoding='utf8'))
-    else:
-        token_to_id = build_token_to_id(vocab)
-        with open(file_token_to_id, 'w', encoding='utf8') as f:
-            json.dump(token_to_id, f, ensure_ascii=False)
-
-    if file_inv_idx.exists():
-        print(f"Loading inverted index from \"{file_inv_idx}\"...")
-        inv_idx = pkl.load(open(file_inv_idx, 'rb'))
-    else:
-        # Building inverted index dictionary
-        print('Building inverted index')
-        inv_idx = {token_to_id[t]: [] for t in vocab}
-        for doc_id, doc in tqdm(enumerate(loader), total=NUM_DOCS):
-            content = doc['content']
-            for para in content:
-                for sent in para:
-                    for t in sent:
-                        if t in inv_idx:
-                            if len(inv_idx[t]) == 0 or inv_idx[t][-1] != doc_id:
-                                inv_idx[t].append(doc_id)
-        print(f'Saving to {file_inv_idx}...')
-        pkl.dump(inv_idx, open(file_inv_idx, 'wb'))
-        # Save a smaller inverted index containing 10k most frequent tokens
-        print('Saving a small inverted index...')
-        small = {t: inv_idx for t in vocab[:1000]}
-        pkl.dump(small, open(data_dir / 'inv_idx_1000.pkl', 'wb'))
+    vocab = load_txt_line(data_dir / 'vocab.txt')
+
+    token_to_id = build_token_to_id(vocab)
+    with open(file_token_to_id, 'w', encoding='utf8') as f:
+        json.dump(token_to_id, f, ensure_ascii=False)
+
+    # Building inverted index dictionary
+    print('Building inverted index')
+    inv_idx = {t: [] for t in vocab}
+    meta_idx = {}
+    days = []
+    for doc_id, doc in tqdm(enumerate(loader), total=NUM_DOCS):
+        for field, key in get_meta_keys(doc).items():
+            meta_idx.setdefault(field, {}).setdefault(key, BitMap()).add(doc_id)
+        days.append(date_to_days(doc['date']))
+        content = doc['content']
+        for para in content:
+            for sent in para:
+                for t in sent:
+                    if t in inv_idx:
+                        if len(inv_idx[t]) == 0 or inv_idx[t][-1] != doc_id:
+                            inv_idx[t].append(doc_id)
+    # Save a smaller inverted index containing 10k most frequent tokens
+    print('Saving a small inverted index...')
+    small = {t: inv_idx[t] for t in vocab[:1000]}
+    pkl.dump(small, open(data_dir / 'inv_idx_1000.pkl', 'wb'))
 
     # Turn postings lists into roaring bitmaps
     print('Converting postings lists to roaring bitmaps...')
     roaring_inv_idx = {}
     for t in tqdm(inv_idx):
         roaring_inv_idx[t] = BitMap(inv_idx[t])
+        roaring_inv_idx[t].run_optimize()
     pkl.dump(roaring_inv_idx, open(file_inv_idx_roaring, 'wb'))
+    MmapPostings.save(roaring_inv_idx, file_inv_idx_mmap)
+    print(f'Compressing postings lists to {file_inv_idx_packed}...')
+    packed = PostingsIndex.build(inv_idx, universe=doc_id + 1)
+    print('Number of terms by codec:', packed.codec_counts())
+    packed.save(file_inv_idx_packed)
+    print(f'Saving metadata index to {file_meta_idx}...')
+    pkl.dump(meta_idx, open(file_meta_idx, 'wb'))
+    save_dates(days, file_id_to_date)
 
     return inv_idx
 
 
-def gen_formatted_docs(data_file: Path, target_file: Path) -> None:
+def _format_range(args) -> [str]:
+    '''
+    Format the docs in a byte range of the data file, return the json of each
+    formatted doc, without the "id" which is assigned by the writer.
+    '''
+    data_file, start, end = args
+    lines = []
+    for doc in jsonl_range_loader(data_file, start, end):
+        lines.append(json.dumps(format_doc(doc), ensure_ascii=False))
+    return lines
+
+
+def gen_formatted_docs(data_file: Path, target_file: Path, num_workers: int=1,
+                       chunk_size: int=2**23) -> int:
     '''
     Format each doc in `data_file` and save to target_file in jsonl format,
     where each line is a json in following format: 
@@ -101,15 +161,33 @@ def gen_formatted_docs(data_file: Path, target_file: Path) -> None:
         
         pos_tag is of the same shape and type, and each corresponding element is
         the POS tag of the corresponding token. 
+
+    The data file is split into chunks of about `chunk_size` bytes, which are
+    formatted by `num_workers` processes. The chunks are written in order, so
+    doc ids are the same as formatting sequentially. Return number of docs.
     '''
-    doc_loader = jsonl_loader(data_file)
-    writer = open(target_file, 'w', encoding='utf8')
-    for doc_id, doc in tqdm(enumerate(doc_loader), total=NUM_DOCS):
-        formatted = format_doc(doc)
-        formatted['id'] = doc_id
+    num_chunks = max(os.path.getsize(data_file) // chunk_size, 1)
+    chunks = [(data_file, start, end)
+              for start, end in split_byte_ranges(data_file, num_chunks)]
 
-        # Save to file
-        writer.write(json.dumps(formatted, ensure_ascii=False) + '\n')
+    doc_id = 0
+    start_time = time.time()
+    with Pool(num_workers) as pool, \
+            open(target_file, 'w', encoding='utf8') as writer, \
+            tqdm(total=chunks[-1][2], unit='B', unit_scale=True) as pbar:
+        # `imap` yields results in the same order as `chunks`
+        for (_, start, end), lines in zip(chunks, pool.imap(_format_range, chunks)):
+            for line in lines:
+                # Append id as the last key, like `formatted['id'] = doc_id`
+                writer.write(f'{line[:-1]}, "id": {doc_id}}}\n')
+                doc_id += 1
+            pbar.update(end - start)
+            pbar.set_postfix(docs=doc_id)
+
+    elapsed = time.time() - start_time
+    print(f'Formatted {doc_id} docs in {elapsed:.2f}s '
+          f'({doc_id / elapsed:.0f} docs/s) with {num_workers} workers')
+    return doc_id
 
 
 def add_all_docs_to_es(data_file: Path, es_index: str) -> None:
@@ -150,39 +228,145 @@ def add_all_docs_to_es(data_file: Path, es_index: str) -> None:
             print(f'[{i}/{NUM_DOCS}] elapsed: {elapsed:.2f}, eta: {eta:.2f}')
 
 
-def build_id_to_date(data_file: Path, target_file: Path) -> None:
+def pack_sim_docs(sim_docs_dir: Path, target_file: Path) -> None:
     '''
-    Build a dictionary of date to doc ids.
+    Concatenate the pickled chunks of similar docs into one array (a row of
+    doc ids for each doc), which the backend memory-maps.
     '''
-    doc_loader = jsonl_loader(data_file)
-    with open(target_file, 'w') as f:
-        for doc in tqdm(doc_loader):
-            f.write(f'{doc["id"]}\t{doc["date"]}\n')
+    chunks = sorted(Path(sim_docs_dir).glob('*.pkl'),
+                    key=lambda f: int(f.stem.split('_')[0]))
+    rows = []
+    for chunk in tqdm(chunks):
+        with open(chunk, 'rb') as f:
+            rows += pkl.load(f)
+    np.save(target_file, np.array(rows, dtype=np.int32))
 
 
-def main():
-    data_dir = Path('..', 'data')
+def _sbert_func(name: str):
+    '''
+    Function `name` in `sbert/embedder.py`, which is only imported when called,
+    so SentenceBERT is not needed unless its stages are run.
+    '''
+    def func(**kwargs):
+        sys.path.append(str(Path(__file__).resolve().parent / 'sbert'))
+        import embedder
+        return getattr(embedder, name)(**kwargs)
+    return func
+
+
+def get_stages(data_dir: Path, num_workers: int, reorder: str=None) -> [Stage]:
+    '''
+    All stages of preprocessing, see `preprocess/pipeline.py`. If `reorder`
+    is given, docs are given new ids in that order (see
+    `preprocess/reorder.py`) before any other stage.
+    '''
     data_file = data_dir / 'rmrb_2000-2015.jsonl'
-    docs_file = data_dir / 'docs.jsonl'
-    id_to_date_file = data_dir / 'id_to_date.txt'
+    formatted_file = data_dir / 'docs.jsonl'
+    docs_file = formatted_file
+    if reorder:
+        docs_file = data_dir / 'docs_reordered.jsonl'
+    stats_file = data_dir / 'corpus_stats.npz'
+    vocab_file = data_dir / 'vocab.txt'
+    text_docs_file = data_dir / 'text_docs.jsonl'
+    embeddings_file = data_dir / 'embeddings.pkl'
     ES_INDEX = 'rmrb_00-15'
-    ES_INDEX_INV_IDX = 'test_inv_idx'
 
-    if not docs_file.exists():
-        print("Formatting docs to " + str(docs_file))
-        gen_formatted_docs(data_file, docs_file)
+    stages = [
+        Stage('format', partial(gen_formatted_docs, num_workers=num_workers),
+              inputs=[data_file], outputs=[formatted_file],
+              params={'data_file': data_file, 'target_file': formatted_file},
+              cpu_bound=True),
+        Stage('stats', partial(gen_stats, num_workers=num_workers),
+              inputs=[docs_file], outputs=[stats_file],
+              params={'docs_file': docs_file, 'target_file': stats_file},
+              cpu_bound=True),
+        Stage('vocab', build_vocab,
+              inputs=[stats_file, data_dir / 'stopwords_all.txt'],
+              outputs=[data_dir / 'token_freq.pkl', vocab_file],
+              params={'data_dir': data_dir, 'min_freq': 2}),
+        # Takes about 2.5 min
+        Stage('inv_idx', build_inv_idx,
+              inputs=[docs_file, vocab_file],
+              outputs=[data_dir / 'token_to_id.json',
+                       data_dir / 'inv_idx_1000.pkl',
+                       data_dir / 'inv_idx_roaring.pkl',
+                       data_dir / 'inv_idx_roaring.bin',
+                       data_dir / 'inv_idx_packed.pkl',
+                       data_dir / 'meta_idx_roaring.pkl',
+                       data_dir / 'id_to_date.npy'],
+              params={'data_dir': data_dir, 'docs_file': docs_file},
+              cpu_bound=True),
+        Stage('token_store', partial(build_token_store, num_workers=num_workers),
+              inputs=[docs_file], outputs=[data_dir / 'token_store'],
+              params={'docs_file': docs_file,
+                      'target_dir': data_dir / 'token_store'},
+              cpu_bound=True),
+        Stage('dedup', partial(build_dup_clusters, num_workers=num_workers),
+              inputs=[docs_file],
+              outputs=[data_dir / 'dup_clusters.npy',
+                       data_dir / 'canonical_docs.pkl'],
+              params={'docs_file': docs_file, 'data_dir': data_dir},
+              cpu_bound=True),
+        # Takes about an hour
+        Stage('es', add_all_docs_to_es,
+              inputs=[docs_file], outputs=[],
+              params={'data_file': docs_file, 'es_index': ES_INDEX}),
+        Stage('text_docs', _sbert_func('gen_text_docs'),
+              inputs=[docs_file], outputs=[text_docs_file],
+              params={'docs_file': docs_file,
+                      'text_docs_file': text_docs_file}),
+        # Takes about 4h on GPU
+        Stage('embeddings', _sbert_func('gen_embeddings'),
+              inputs=[text_docs_file], outputs=[embeddings_file],
+              params={'text_docs_file': text_docs_file,
+                      'embeddings_file': embeddings_file}),
+        Stage('similar_docs', _sbert_func('gen_sim_docs'),
+              inputs=[embeddings_file], outputs=[data_dir / 'similar_docs'],
+              params={'embeddings_file': embeddings_file,
+                      'output_dir': data_dir / 'similar_docs',
+                      'topk': 100, 'chunk_size': 2**12}),
+        Stage('pack_similar_docs', pack_sim_docs,
+              inputs=[data_dir / 'similar_docs'],
+              outputs=[data_dir / 'similar_docs.npy'],
+              params={'sim_docs_dir': data_dir / 'similar_docs',
+                      'target_file': data_dir / 'similar_docs.npy'}),
+    ]
+    if reorder:
+        stages.append(
+            Stage('reorder', partial(reorder_docs, num_workers=num_workers),
+                  inputs=[formatted_file],
+                  outputs=[docs_file, data_dir / 'id_map.npy'],
+                  params={'docs_file': formatted_file, 'target_file': docs_file,
+                          'id_map_file': data_dir / 'id_map.npy',
+                          'order': reorder},
+                  cpu_bound=True))
+    return stages
+
+
+# Stages run by default, the SentenceBERT ones take hours on GPU.
+DEFAULT_STAGES = ['format', 'stats', 'vocab', 'inv_idx', 'token_store',
+                  'dedup', 'es']
 
-    print("Building inverted index...")
-    build_inv_idx(data_dir, ES_INDEX_INV_IDX)     # Takes about 2.5 min
-    
-    print("Adding documents to Elasticsearch...")
-    add_all_docs_to_es(docs_file, ES_INDEX)       # Takes about an hour
 
-    print("Building id to date dict...")
-    build_id_to_date(docs_file, id_to_date_file)  # Takes about 1 min
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('stages', nargs='*', default=DEFAULT_STAGES,
+                        help='Stages to run, along with the stages they depend '
+                             'on. Default: ' + ' '.join(DEFAULT_STAGES))
+    parser.add_argument('--force', nargs='*', default=[],
+                        help='Stages to run even if they are up to date')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes for CPU-bound stages')
+    parser.add_argument('--reorder', choices=ORDERS,
+                        help='Reassign doc ids in this order before indexing')
+    args = parser.parse_args()
 
+    data_dir = Path('..', 'data')
+    pipeline = Pipeline(get_stages(data_dir, args.workers, args.reorder),
+                        state_dir=data_dir / '.pipeline')
+    pipeline.run(args.stages, args.force)
     print("Done preprocessing")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,118 @@
+# coding: utf8
+'''
+Near-duplicate detection, for reprinted and near-identical articles.
+
+Each doc is the set of its shingles (`SHINGLE_SIZE` consecutive tokens), and
+its MinHash signature (see `minhash.py`) is computed in parallel over byte
+ranges of the docs. Docs whose signatures are equal on all rows of any of the
+`NUM_BANDS` bands are candidates (LSH), and candidates whose signatures agree
+on at least `THRESHOLD` of the entries (the estimated Jaccard similarity) are
+duplicates. Clusters are the connected components of the duplicate pairs.
+Empty docs all have the same signature but nothing in common, so they are
+left out of the bands and each is its own cluster.
+
+Saved in the data directory:
+
+    dup_clusters.npy: the cluster of each doc, the smallest doc id in it.
+    canonical_docs.pkl: a pickled BitMap of the docs that are the canonical
+        doc of their cluster (every doc without duplicates is one), the
+        backend collapses duplicates by AND-ing results with it.
+'''
+import pickle as pkl
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from pyroaring import BitMap
+from tqdm import tqdm
+
+from .file_utils import split_byte_ranges, jsonl_range_loader
+from .minhash import get_permutations, minhash_signature, MAX_HASH
+
+SHINGLE_SIZE = 3
+NUM_BANDS = 16
+ROWS_PER_BAND = 4
+NUM_PERM = NUM_BANDS * ROWS_PER_BAND
+THRESHOLD = 0.8
+
+
+def get_shingles(tokens: [str], size: int=SHINGLE_SIZE) -> [str]:
+    '''All runs of `size` consecutive tokens, the tokens if there are fewer'''
+    if len(tokens) < size:
+        return tokens
+    return ['\x00'.join(tokens[i:i + size])
+            for i in range(len(tokens) - size + 1)]
+
+
+def _signatures_range(args) -> np.ndarray:
+    '''MinHash signatures of the docs in a byte range of the docs file'''
+    docs_file, start, end = args
+    perms = get_permutations(NUM_PERM)
+    res = []
+    for doc in jsonl_range_loader(docs_file, start, end):
+        tokens = [t for para in doc['content'] for sent in para for t in sent]
+        res.append(minhash_signature(get_shingles(tokens), *perms))
+    return np.array(res, dtype=np.uint32).reshape(-1, NUM_PERM)
+
+
+def candidate_pairs(signatures: np.ndarray) -> np.ndarray:
+    '''
+    (a, b) pairs of non-empty docs that share a band, as an array of shape
+    (n, 2). In each band, each doc is paired with the first doc of its bucket
+    only, the clusters are the same.
+    '''
+    doc_ids = np.nonzero((signatures != MAX_HASH).any(axis=1))[0]
+    signatures = signatures[doc_ids]
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for band in range(NUM_BANDS):
+        rows = signatures[:, band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        keys = np.ascontiguousarray(rows).view(
+            np.dtype((np.void, rows.dtype.itemsize * ROWS_PER_BAND))).ravel()
+        _, first, bucket = np.unique(keys, return_index=True,
+                                     return_inverse=True)
+        heads = first[bucket.ravel()]
+        ids = np.nonzero(heads != np.arange(len(keys)))[0]
+        pairs.append(np.stack([heads[ids], ids], axis=1))
+    return doc_ids[np.unique(np.concatenate(pairs), axis=0)]
+
+
+def find_clusters(signatures: np.ndarray,
+                  threshold: float=THRESHOLD) -> np.ndarray:
+    '''The cluster of each doc, the smallest doc id in it'''
+    pairs = candidate_pairs(signatures)
+    sims = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+    pairs = pairs[sims >= threshold]
+
+    # Union-find, the root of a cluster is its smallest doc id
+    parent = list(range(len(signatures)))
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for a, b in pairs.tolist():
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    return np.array([find(i) for i in range(len(parent))], dtype=np.int32)
+
+
+def build_dup_clusters(docs_file: Path, data_dir: Path,
+                       num_workers: int=1) -> None:
+    print('Computing MinHash signatures...')
+    ranges = [(docs_file, start, end)
+              for start, end in split_byte_ranges(docs_file, num_workers * 4)]
+    with Pool(num_workers) as pool:
+        signatures = np.concatenate(list(tqdm(
+            pool.imap(_signatures_range, ranges), total=len(ranges))))
+
+    clusters = find_clusters(signatures)
+    canonical = BitMap(
+        np.nonzero(clusters == np.arange(len(clusters)))[0].tolist())
+    data_dir = Path(data_dir)
+    np.save(data_dir / 'dup_clusters.npy', clusters)
+    with open(data_dir / 'canonical_docs.pkl', 'wb') as f:
+        pkl.dump(canonical, f)
+    dups = clusters[clusters != np.arange(len(clusters))]
+    print(f'{len(dups)} of {len(clusters)} docs are duplicates, in '
+          f'{len(np.unique(dups))} clusters')
@@ -1,4 +1,5 @@
 # coding: utf8
+import os
 import json
 
 
@@ -31,6 +32,38 @@ def jsonl_loader(fname: str):
         yield data
 
 
+def split_byte_ranges(fname: str, num_ranges: int) -> [(int, int)]:
+    '''
+    Split a file into at most `num_ranges` byte ranges [start, end) of about
+    the same size, where each range starts at the beginning of a line.
+    '''
+    size = os.path.getsize(fname)
+    bounds = [0]
+    with open(fname, 'rb') as f:
+        for i in range(1, num_ranges):
+            f.seek(size * i // num_ranges)
+            f.readline()    # Move to the start of next line
+            bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+
+def jsonl_range_loader(fname: str, start: int, end: int):
+    '''
+    Return the generator that yields the lines starting in the byte range
+    [start, end) of jsonl one by one, `start` should be the start of a line.
+    '''
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield json.loads(line)
+
+
 def save_txt_line(lines: [str], fname: str) -> None:
     '''Save list of str to file as ascii where each element is one line'''
     with open(fname, 'w', encoding='utf8') as f:
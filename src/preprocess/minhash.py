@@ -0,0 +1,43 @@
+# coding: utf8
+'''
+MinHash signatures of sets of tokens: for each of `num_perm` random hash
+functions, the min. hash of the tokens. Two sets agree on each entry with
+probability equal to their Jaccard similarity.
+'''
+import zlib
+
+import numpy as np
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def get_permutations(num_perm: int, seed: int=0) -> (np.ndarray, np.ndarray):
+    '''
+    Parameters (a, b) of the hash functions h(x) = (a * x + b) mod p. They
+    are drawn from all of [0, p): with small `a`, `a * x` is less than a few
+    `p` and the order of the hashes barely depends on `a`, so all functions
+    pick about the same min.
+    '''
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def hash_tokens(tokens: [str]) -> np.ndarray:
+    '''32-bit hashes of the distinct tokens, the same in every process'''
+    return np.array([zlib.crc32(t.encode('utf8')) for t in set(tokens)],
+                    dtype=np.uint64)
+
+
+def minhash_signature(tokens: [str], a: np.ndarray,
+                      b: np.ndarray) -> np.ndarray:
+    '''MinHash signature of a set of tokens, all MAX_HASH if it is empty'''
+    hashes = hash_tokens(tokens)
+    if len(hashes) == 0:
+        return np.full(len(a), MAX_HASH, dtype=np.uint32)
+    # `a * x + b` overflows, it is computed mod 2^64 before mod p
+    with np.errstate(over='ignore'):
+        h = (np.outer(hashes, a) + b) % np.uint64(MERSENNE_PRIME)
+    return (h.min(axis=0) & np.uint64(MAX_HASH)).astype(np.uint32)
@@ -0,0 +1,192 @@
+# coding: utf8
+'''
+A small runner for the preprocessing pipeline.
+
+Each stage declares its input and output files and its parameters. A stage is
+skipped if its inputs (by content hash) and parameters are the same as the
+last time it was run, and its outputs are still what that run produced.
+Stages that do not depend on each other run concurrently, except CPU-bound
+ones (e.g. with their own pool of `--workers` processes), which run one at a
+time, so that the processes and their memory are not multiplied by the
+number of concurrent stages.
+
+The state of each stage (hashes and timing of the last run) is saved in
+`state_dir` as `<stage name>.json`.
+'''
+import json
+import time
+import hashlib
+import threading
+from contextlib import nullcontext
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Stage:
+    '''
+    A step of the pipeline, running it calls `func(**params)`, which should
+    read `inputs` and write `outputs`. Paths of outputs can be directories.
+    At most one `cpu_bound` stage runs at a time.
+    '''
+    def __init__(self, name: str, func, inputs: [Path], outputs: [Path],
+                 params: dict=None, cpu_bound: bool=False):
+        self.name = name
+        self.func = func
+        self.inputs = [Path(p) for p in inputs]
+        self.outputs = [Path(p) for p in outputs]
+        self.params = params or {}
+        self.cpu_bound = cpu_bound
+
+
+class Pipeline:
+    '''A DAG of stages, where a stage depends on the stages producing its inputs.'''
+    def __init__(self, stages: [Stage], state_dir: Path, max_workers: int=4):
+        self.stages = {s.name: s for s in stages}
+        self.state_dir = Path(state_dir)
+        self.max_workers = max_workers
+
+        # Stage producing each file
+        producers = {}
+        for stage in stages:
+            for p in stage.outputs:
+                producers[p] = stage.name
+        self.deps = {
+            s.name: {producers[p] for p in s.inputs if p in producers}
+            for s in stages}
+
+        # Cache of file hashes: {path: [size, mtime_ns, hash]}, so that
+        # unchanged files are not hashed again on every run.
+        self.file_hash_cache = self._load_json(self.state_dir / 'hashes.json')
+        self.lock = threading.Lock()
+        # Held by the running CPU-bound stage
+        self.cpu_lock = threading.Lock()
+
+    @staticmethod
+    def _load_json(file: Path) -> dict:
+        if file.exists():
+            with open(file, 'r', encoding='utf8') as f:
+                return json.load(f)
+        return {}
+
+    def _hash_file(self, file: Path) -> str:
+        stat = file.stat()
+        key = str(file)
+        with self.lock:
+            cached = self.file_hash_cache.get(key)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        h = hashlib.blake2b(digest_size=16)
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self.lock:
+            self.file_hash_cache[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def hash_path(self, path: Path) -> str:
+        '''Content hash of a file or a directory, None if it does not exist.'''
+        if path.is_dir():
+            h = hashlib.blake2b(digest_size=16)
+            for file in sorted(path.rglob('*')):
+                if file.is_file():
+                    h.update(str(file.relative_to(path)).encode('utf8'))
+                    h.update(self._hash_file(file).encode('ascii'))
+            return h.hexdigest()
+        if path.exists():
+            return self._hash_file(path)
+        return None
+
+    def _stage_key(self, stage: Stage) -> str:
+        '''Hash of everything that determines the outputs of a stage.'''
+        h = hashlib.blake2b(digest_size=16)
+        h.update(stage.name.encode('utf8'))
+        h.update(json.dumps(stage.params, sort_keys=True, default=str)
+                 .encode('utf8'))
+        for p in stage.inputs:
+            digest = self.hash_path(p)
+            if digest is None:
+                raise FileNotFoundError(f'Input of stage "{stage.name}" '
+                                        f'not found: {p}')
+            h.update(digest.encode('ascii'))
+        return h.hexdigest()
+
+    def is_up_to_date(self, stage: Stage, key: str) -> bool:
+        state = self._load_json(self.state_dir / f'{stage.name}.json')
+        if state.get('key') != key:
+            return False
+        outputs = {str(p): self.hash_path(p) for p in stage.outputs}
+        return outputs == state.get('outputs')
+
+    def run_stage(self, stage: Stage, force: bool=False) -> dict:
+        '''Run a stage if it is not up to date, return its state.'''
+        key = self._stage_key(stage)
+        if not force and self.is_up_to_date(stage, key):
+            print(f'[{stage.name}] Up to date, skipped')
+            return {'skipped': True, 'elapsed': 0.0}
+
+        with self.cpu_lock if stage.cpu_bound else nullcontext():
+            print(f'[{stage.name}] Running...')
+            start_time = time.time()
+            stage.func(**stage.params)
+            elapsed = time.time() - start_time
+            print(f'[{stage.name}] Done in {elapsed:.2f}s')
+
+        state = {
+            'key': key,
+            'outputs': {str(p): self.hash_path(p) for p in stage.outputs},
+            'elapsed': elapsed,
+            'finished_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        with open(self.state_dir / f'{stage.name}.json', 'w',
+                  encoding='utf8') as f:
+            json.dump(state, f, indent=2)
+        return {'skipped': False, 'elapsed': elapsed}
+
+    def _closure(self, targets: [str]) -> {str}:
+        '''All stages needed to run for `targets`.'''
+        needed = set()
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.deps[name])
+        return needed
+
+    def run(self, targets: [str]=None, force: [str]=()) -> {str: dict}:
+        '''
+        Run the `targets` stages (default: all) and the stages they depend
+        on, stages in `force` are run even if they are up to date.
+
+        Return {stage name: {'skipped': bool, 'elapsed': float}}.
+        '''
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        if targets is None:
+            targets = list(self.stages)
+        needed = self._closure(targets)
+        results = {}
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                while len(results) < len(needed):
+                    for name in needed:
+                        ready = self.deps[name] <= set(results)
+                        if ready and name not in results and name not in running.values():
+                            future = executor.submit(
+                                self.run_stage, self.stages[name], name in force)
+                            running[future] = name
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        results[name] = future.result()
+        finally:
+            with open(self.state_dir / 'hashes.json', 'w',
+                      encoding='utf8') as f:
+                json.dump(self.file_hash_cache, f)
+
+        print('Timing of stages:')
+        for name, result in results.items():
+            status = 'skipped' if result['skipped'] else f'{result["elapsed"]:.2f}s'
+            print(f'  {name}: {status}')
+        return results
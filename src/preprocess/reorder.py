@@ -0,0 +1,91 @@
+# coding: utf8
+'''
+Reassign doc ids so that similar docs get close ids. The postings lists of
+a term then have more docs in the same roaring containers and more runs, so
+the index is smaller and the bitmap operations are faster.
+
+Orders:
+    date: by date.
+    column_date: by column, then date.
+    minhash: by column, then the MinHash signature of the tokens, so that
+        docs sharing rare terms end up next to each other.
+
+Ties are kept in the original order.
+'''
+import json
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from .file_utils import split_byte_ranges
+from .minhash import get_permutations, minhash_signature
+
+ORDERS = ['date', 'column_date', 'minhash']
+# Number of hash functions of the signature used as the sort key
+NUM_PERM = 4
+
+
+def get_sort_key(doc: dict, order: str, perms=None) -> tuple:
+    if order == 'date':
+        return (doc['date'],)
+    if order == 'column_date':
+        return (doc['column'].strip(), doc['date'])
+    if order == 'minhash':
+        tokens = [t for para in doc['content'] for sent in para for t in sent]
+        return (doc['column'].strip(),
+                *minhash_signature(tokens, *perms).tolist())
+    raise ValueError(f'Invalid order: {order}')
+
+
+def _sort_keys_range(args) -> [(tuple, int, int)]:
+    '''(sort key, byte offset, byte length) of each doc in a byte range'''
+    docs_file, start, end, order = args
+    perms = get_permutations(NUM_PERM) if order == 'minhash' else None
+    res = []
+    with open(docs_file, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            res.append((get_sort_key(json.loads(line), order, perms), pos,
+                        len(line)))
+            pos += len(line)
+    return res
+
+
+def reorder_docs(docs_file: Path, target_file: Path, id_map_file: Path,
+                 order: str='column_date', num_workers: int=1) -> None:
+    '''
+    Write the docs of `docs_file` (see `gen_formatted_docs`) to
+    `target_file` sorted by `order`, with their new ids, and save the new id
+    to old id map, an array where `id_map[new_id] = old_id`, to `id_map_file`
+    (.npy).
+
+    Every later stage reads `target_file`, so the ids of the index, the
+    dates, Elasticsearch and the embeddings are all the new ids.
+    '''
+    print(f'Computing sort keys ({order})...')
+    ranges = [(docs_file, start, end, order)
+              for start, end in split_byte_ranges(docs_file, num_workers * 8)]
+    docs = []
+    with Pool(num_workers) as pool:
+        for keys in tqdm(pool.imap(_sort_keys_range, ranges), total=len(ranges)):
+            docs += keys
+    # Stable sort, docs with equal keys keep their original order
+    id_map = sorted(range(len(docs)), key=lambda i: docs[i][0])
+
+    print(f'Writing reordered docs to {target_file}...')
+    with open(docs_file, 'rb') as reader, \
+            open(target_file, 'w', encoding='utf8') as writer:
+        for new_id, old_id in enumerate(tqdm(id_map)):
+            _, offset, length = docs[old_id]
+            reader.seek(offset)
+            line = reader.read(length).decode('utf8').rstrip('\n')
+            # The id is the last key, see `gen_formatted_docs`
+            line = line[:line.rindex(', "id": ')]
+            writer.write(f'{line}, "id": {new_id}}}\n')
+    np.save(id_map_file, np.array(id_map, dtype=np.int32))
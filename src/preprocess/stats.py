@@ -0,0 +1,127 @@
+# coding: utf8
+from collections import Counter
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from .file_utils import split_byte_ranges, jsonl_range_loader
+
+
+def encode_strs(strs: [str]) -> np.ndarray:
+    '''Pack a list of str (without newlines) into one array of utf8 bytes'''
+    return np.frombuffer('\n'.join(strs).encode('utf8'), dtype=np.uint8)
+
+
+def decode_strs(arr: np.ndarray) -> [str]:
+    '''Inverse of `encode_strs`'''
+    if len(arr) == 0:
+        return []
+    return arr.tobytes().decode('utf8').split('\n')
+
+
+class CorpusStats:
+    '''
+    Statistics of a corpus of formatted docs (see `gen_formatted_docs`) that
+    are gathered in one pass. Stats of different shards of the corpus can be
+    gathered in parallel, then merged.
+
+    term_freq: {str: int}, number of occurrences of each term.
+    doc_freq: {str: int}, number of docs containing each term.
+    doc_lens: {int: int}, number of tokens in each doc, by doc id.
+    column_counts: {str: int}, number of docs in each column.
+    '''
+    def __init__(self):
+        self.term_freq = Counter()
+        self.doc_freq = Counter()
+        self.doc_lens = {}
+        self.column_counts = Counter()
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_lens)
+
+    def add_doc(self, doc: dict):
+        '''Add a new document to the stats'''
+        tokens = [t for para in doc['content'] for sent in para for t in sent]
+        self.term_freq.update(tokens)
+        self.doc_freq.update(set(tokens))
+        self.doc_lens[doc['id']] = len(tokens)
+        self.column_counts[doc['column'].strip()] += 1
+
+    def merge(self, other: 'CorpusStats') -> 'CorpusStats':
+        '''Add the stats of another (disjoint) shard of the corpus to this'''
+        self.term_freq.update(other.term_freq)
+        self.doc_freq.update(other.doc_freq)
+        self.doc_lens.update(other.doc_lens)
+        self.column_counts.update(other.column_counts)
+        return self
+
+    def save(self, file: Path):
+        '''
+        Save to one .npz file. Terms are sorted by descending term freq., doc
+        lengths are stored as an array indexed by doc id.
+        '''
+        terms = sorted(self.term_freq, key=lambda t: self.term_freq[t],
+                       reverse=True)
+        columns = sorted(self.column_counts)
+        doc_lens = np.zeros(max(self.doc_lens, default=-1) + 1, dtype=np.int32)
+        doc_lens[list(self.doc_lens)] = list(self.doc_lens.values())
+        np.savez(
+            file,
+            terms=encode_strs(terms),
+            term_freq=np.array([self.term_freq[t] for t in terms],
+                               dtype=np.int64),
+            doc_freq=np.array([self.doc_freq[t] for t in terms],
+                              dtype=np.int64),
+            doc_lens=doc_lens,
+            columns=encode_strs(columns),
+            column_counts=np.array([self.column_counts[c] for c in columns],
+                                   dtype=np.int64))
+
+    @classmethod
+    def load(cls, file: Path) -> 'CorpusStats':
+        data = np.load(file)
+        terms = decode_strs(data['terms'])
+        columns = decode_strs(data['columns'])
+        stats = cls()
+        stats.term_freq = Counter(dict(zip(terms, data['term_freq'].tolist())))
+        stats.doc_freq = Counter(dict(zip(terms, data['doc_freq'].tolist())))
+        stats.doc_lens = dict(enumerate(data['doc_lens'].tolist()))
+        stats.column_counts = Counter(
+            dict(zip(columns, data['column_counts'].tolist())))
+        return stats
+
+
+def _build_shard_stats(args) -> CorpusStats:
+    '''Gather the stats of docs in a byte range of the docs file'''
+    docs_file, start, end = args
+    stats = CorpusStats()
+    for doc in jsonl_range_loader(docs_file, start, end):
+        stats.add_doc(doc)
+    return stats
+
+
+def build_stats(docs_file: Path, num_workers: int=8) -> CorpusStats:
+    '''
+    Gather the stats of all docs in `docs_file` in one pass, by splitting it
+    into shards processed by `num_workers` processes.
+    '''
+    # More shards than workers, so that the progress bar is meaningful.
+    ranges = split_byte_ranges(docs_file, num_workers * 8)
+    shards = [(docs_file, start, end) for start, end in ranges]
+    stats = CorpusStats()
+    with Pool(num_workers) as pool:
+        for shard_stats in tqdm(pool.imap_unordered(_build_shard_stats, shards),
+                                total=len(shards)):
+            stats.merge(shard_stats)
+    return stats
+
+
+
+def gen_stats(docs_file: Path, target_file: Path, num_workers: int=8) -> None:
+    '''Gather the stats of all docs in `docs_file` and save to `target_file`'''
+    stats = build_stats(docs_file, num_workers)
+    print(f'Saving stats of {stats.num_docs} docs to {target_file}')
+    stats.save(target_file)
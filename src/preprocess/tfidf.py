@@ -1,3 +1,4 @@
+import sys
 from math import log
 from pathlib import Path
 import json
@@ -10,6 +11,10 @@ from scipy import sparse
 
 from file_utils import jsonl_loader, save_jsonl, load_txt_line, save_txt_line
 
+sys.path.append('..')
+from preprocess.stats import CorpusStats
+from preprocess.token_filter import filter_tokens, print_report
+
 
 class TfIdf:
     '''Class for building a matrix of TF-IDF values.'''
@@ -19,6 +24,17 @@ class TfIdf:
         self.df = {t: 0 for t in vocab}
         self.corpus_size = 0
 
+    @classmethod
+    def from_stats(cls, vocab: [str], stats: CorpusStats) -> 'TfIdf':
+        '''
+        Get the document frequencies from corpus stats, instead of calling
+        `add_docs` with all docs.
+        '''
+        tfidf = cls(vocab)
+        tfidf.df = {t: stats.doc_freq.get(t, 0) for t in vocab}
+        tfidf.corpus_size = stats.num_docs
+        return tfidf
+
     def add_docs(self, docs):
         '''Process list of docs'''
         for doc in docs:
@@ -110,6 +126,53 @@ class TfIdf:
         return mat
 
 
+def build_sparse_tfidf(tfidf: TfIdf, docs, out_dir: Path) -> (int, int):
+    '''
+    Stream through `docs` and write the (docs x vocab) TF-IDF matrix to
+    `out_dir` as a CSR matrix in raw binary files, so that it can be
+    memory-mapped later instead of being loaded (or built) as a whole:
+
+        data.bin     float32, the non-zero values
+        indices.bin  int32, the term index of each value
+        indptr.bin   int64, offsets of each doc (row) into data and indices
+        meta.json    {"shape": [num_docs, vocab_size], "nnz": nnz}
+
+    `docs` should be the same as the docs that was added to `tfidf` by
+    calling `add_docs` or `add_doc`. Return the shape of the matrix.
+    '''
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    term_to_idx = {t: i for i, t in enumerate(tfidf.vocab)}
+    idf = np.array([tfidf.get_idf(t) for t in tfidf.vocab], dtype=np.float32)
+
+    nnz = 0
+    num_docs = 0
+    f_data = open(out_dir / 'data.bin', 'wb')
+    f_indices = open(out_dir / 'indices.bin', 'wb')
+    f_indptr = open(out_dir / 'indptr.bin', 'wb')
+    f_indptr.write(np.array([0], dtype=np.int64).tobytes())
+    for doc in tqdm(docs):
+        tf_dict = tfidf.doc_to_tf_dict(doc['content'])
+        indices = np.array(sorted(term_to_idx[t] for t in tf_dict),
+                           dtype=np.int32)
+        values = np.array([tf_dict[tfidf.vocab[i]] for i in indices],
+                          dtype=np.float32)
+        values *= idf[indices]
+        f_data.write(values.tobytes())
+        f_indices.write(indices.tobytes())
+        nnz += len(indices)
+        num_docs += 1
+        f_indptr.write(np.array([nnz], dtype=np.int64).tobytes())
+    f_data.close()
+    f_indices.close()
+    f_indptr.close()
+
+    shape = (num_docs, len(tfidf.vocab))
+    with open(out_dir / 'meta.json', 'w') as f:
+        json.dump({'shape': shape, 'nnz': nnz}, f)
+    return shape
+
+
 def get_docs_by_column(column: str, doc_loader) -> [dict]:
     docs = []
     for i, doc in tqdm(enumerate(doc_loader)):
@@ -136,39 +199,14 @@ def build_vocab(docs, min_term_freq=4) -> [str]:
     vocab = sorted(term_freq.keys(), key=lambda x: term_freq[x], reverse=True)
     print('Original vocab size:', len(vocab))
 
-    vocab = [w for w in vocab if w.strip()]
-
-    # Remove stopwords
-    print('Removing stopwords...')
-    stopwords = load_txt_line('../../data/stopwords_all.txt')
-    stopwords = set(stopwords)
-    vocab = [w for w in vocab if w not in stopwords]
-    print('Vocab size after removing stopwords:', len(vocab))
-
-    # Remove infrequent words
-    print(f'Removing infrequent words (frequency < {min_term_freq})...')
-    vocab = [t for t in vocab if term_freq[t] >= min_term_freq]
-    print('Vocab size after removing infrequent words:', len(vocab))
-
-    # Remove expressions
-    print('Removing expressions...')
-    new_vocab = []
-
-    for t in vocab:
-        for s in ['.', '%', '&', ',', '^', '+', '-', '—', '*', '/', '$', '(', 
-                  ':', ')', '￥', '@', '号', '第', 'st', 'nd', 'th', 's']:
-            normed = t.replace(s, '')
-        if not normed.isdecimal():
-            new_vocab.append(t)
-    vocab = new_vocab
-    print('Vocab size after removing expressions:', len(vocab))
-
-    # # Remove punctuations
-    # print('Removing punctuations...')
-    # punctuations = '!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~《》，。、！@#￥%……&（）-_·~[]；‘：“'
-    # vocab = [t for t in vocab if t not in punctuations]
-    # print('Vocab size after removing punctuations:', len(vocab))
-
+    # Remove whitespaces, stopwords, infrequent words and expressions (numbers
+    # with symbols or units, e.g. "1.5%", "20th", "第3").
+    freqs = np.array([term_freq[t] for t in vocab], dtype=np.int64)
+    rules = ['whitespace', 'stopword', 'numeric', 'rare']
+    mask, report = filter_tokens(vocab, freqs, min_term_freq, rules)
+    print_report(report, len(vocab))
+    vocab = [t for t, keep in zip(vocab, mask) if keep]
+    print('Vocab size after filtering:', len(vocab))
     return vocab
 
 
@@ -211,6 +249,16 @@ def main():
     sparse_tfidf_mat = csr_matrix(tfidf_mat)
     sparse.save_npz(data_dir / 'tfidf_sparse.npz', sparse_tfidf_mat)
 
+    # Build TF-IDF of the whole corpus, this is never held in memory, but
+    # written row by row, for out-of-core LSI.
+    print('Building TF-IDF matrix of the whole corpus...')
+    vocab = load_txt_line(data_dir / 'vocab.txt')
+    stats = CorpusStats.load(data_dir / 'corpus_stats.npz')
+    tfidf = TfIdf.from_stats(vocab, stats)
+    shape = build_sparse_tfidf(tfidf, jsonl_loader(data_dir / 'docs.jsonl'),
+                               data_dir / 'tfidf_csr')
+    print('Size of matrix:', shape)
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
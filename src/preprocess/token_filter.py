@@ -0,0 +1,105 @@
+# coding: utf8
+'''
+Filtering of tokens for building vocabs.
+
+Every token is classified by one precompiled regex, and stopwords are looked
+up in a frozenset that is loaded once, so the whole vocab is filtered in one
+go, with a report of how many tokens each rule dropped.
+'''
+import re
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+
+FILE_STOPWORDS = Path(__file__).resolve().parents[2] / 'data' / 'stopwords_all.txt'
+
+ZH_PUNC = """　∶’．￥％……＆×＃＼～！？｡。，·＂＃＄％＆＇（）＊＋－／：；＜＝＞＠［＼］＾＿｀｛｜｝～｟｠｢｣､、〃》「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〾〿–—‘'‛“”„‟…‧﹏"""
+EN_PUNC = """!\"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~ """
+
+# Symbols, units and ordinal suffixes that are ignored when checking if a
+# token is a number, e.g. "1.5%", "20th", "第3", "5号".
+NUMERIC_AFFIXES = ['.', '%', '&', ',', '^', '+', '-', '—', '*', '/', '$', '(',
+                   ':', ')', '￥', '@', '号', '第', 'st', 'nd', 'th', 's']
+
+# Each alternative is a rule, the name of the group that matches the whole
+# token is the rule that drops it. NOTE: Stopwords and rare tokens are not
+# checked with this.
+_CLASSIFIER = re.compile('|'.join([
+    r'(?P<whitespace>\s*)',
+    '(?P<punctuation>[' + re.escape(ZH_PUNC + EN_PUNC) + ']+)',
+    # Consists of digits and affixes, with at least one digit.
+    r'(?P<numeric>(?=.*\d)(?:\d|'
+    + '|'.join(re.escape(s) for s in NUMERIC_AFFIXES) + ')+)',
+]))
+
+RULES = ['whitespace', 'stopword', 'punctuation', 'numeric', 'rare']
+
+
+@lru_cache(maxsize=None)
+def load_stopwords(file: Path=FILE_STOPWORDS) -> frozenset:
+    '''Load a stopword file, each line is a word'''
+    with open(file, 'r', encoding='utf8') as f:
+        return frozenset(line.strip() for line in f)
+
+
+def classify(token: str) -> str:
+    '''Return the name of the regex rule that matches `token`, or None'''
+    match = _CLASSIFIER.fullmatch(token)
+    return match.lastgroup if match else None
+
+
+def filter_tokens(tokens: [str], freqs: np.ndarray, min_freq: int=1,
+                  rules: [str]=RULES) -> (np.ndarray, {str: int}):
+    '''
+    Filter a vocab with the given rules, `freqs` is the freq. of each token.
+    Each token is attributed to the first rule (in the order of `RULES`) that
+    drops it.
+
+    Return (mask of kept tokens, {rule: number of tokens dropped}).
+    '''
+    freqs = np.asarray(freqs)
+    if 'stopword' in rules:
+        stopwords = load_stopwords()
+    else:
+        stopwords = frozenset()
+
+    def drop_rule(token: str) -> str:
+        rule = classify(token)
+        if rule == 'whitespace' and rule in rules:
+            return rule
+        if token in stopwords:
+            return 'stopword'
+        if rule in rules:
+            return rule
+        return ''
+
+    # Rule that drops each token, '' if it is kept (by all but "rare")
+    dropped_by = np.array([drop_rule(t) for t in tokens], dtype=object)
+    if 'rare' in rules:
+        dropped_by[(dropped_by == '') & (freqs < min_freq)] = 'rare'
+
+    report = {rule: int(np.sum(dropped_by == rule)) for rule in RULES
+              if rule in rules}
+    return dropped_by == '', report
+
+
+def filter_token_freq(token_freq: {str: int}, min_freq: int=1,
+                      rules: [str]=RULES) -> ({str: int}, {str: int}):
+    '''
+    Dict version of `filter_tokens`, return (filtered token freq., report).
+    '''
+    tokens = list(token_freq)
+    freqs = np.fromiter(token_freq.values(), dtype=np.int64,
+                        count=len(token_freq))
+    mask, report = filter_tokens(tokens, freqs, min_freq, rules)
+    kept = {tokens[i]: int(freqs[i]) for i in np.flatnonzero(mask)}
+    return kept, report
+
+
+def print_report(report: {str: int}, num_tokens: int):
+    '''Log the number of tokens dropped by each rule'''
+    for rule, cnt in report.items():
+        num_tokens -= cnt
+        print(f'  removed {cnt} tokens by rule "{rule}", # tokens = {num_tokens}')
@@ -0,0 +1,77 @@
+# coding: utf8
+'''
+A compact store of the tokens of every doc, for building snippets without
+fetching the docs (see `backend/snippets.py`). Saved in a directory:
+
+    lexicon.txt: all distinct tokens, sorted, a token's id is its line number.
+    tokens.npy: the token ids of all docs, concatenated, uint16 if there are
+        few enough distinct tokens, otherwise uint32.
+    sent_starts.npy: the offset in `tokens` of each sentence, and the total
+        number of tokens at the end.
+    doc_sents.npy: the index of the first sentence of each doc, and the total
+        number of sentences at the end.
+
+Docs are split into byte ranges that are processed in parallel, each with
+its own lexicon, which are then merged.
+'''
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from .file_utils import split_byte_ranges, jsonl_range_loader
+
+
+def _store_range(args) -> tuple:
+    '''
+    Token ids of the docs in a byte range of the docs file, return (lexicon
+    of the range, token ids, length of each sentence, number of sentences of
+    each doc).
+    '''
+    docs_file, start, end = args
+    token_ids = {}
+    ids = []
+    sent_lens = []
+    doc_num_sents = []
+    for doc in jsonl_range_loader(docs_file, start, end):
+        num_sents = 0
+        for para in doc['content']:
+            for sent in para:
+                for t in sent:
+                    ids.append(token_ids.setdefault(t, len(token_ids)))
+                sent_lens.append(len(sent))
+                num_sents += 1
+        doc_num_sents.append(num_sents)
+    return (list(token_ids), np.array(ids, dtype=np.uint32),
+            np.array(sent_lens, dtype=np.int64),
+            np.array(doc_num_sents, dtype=np.int64))
+
+
+def build_token_store(docs_file: Path, target_dir: Path,
+                      num_workers: int=1) -> None:
+    chunks = [(docs_file, start, end)
+              for start, end in split_byte_ranges(docs_file, num_workers * 4)]
+    with Pool(num_workers) as pool:
+        results = list(tqdm(pool.imap(_store_range, chunks), total=len(chunks)))
+
+    lexicon = sorted(set(t for res in results for t in res[0]))
+    global_ids = {t: i for i, t in enumerate(lexicon)}
+    dtype = np.uint16 if len(lexicon) <= 2**16 else np.uint32
+    tokens = np.concatenate(
+        [np.array([global_ids[t] for t in local], dtype=np.uint32)[ids]
+         for local, ids, _, _ in results]).astype(dtype)
+    sent_lens = np.concatenate([res[2] for res in results])
+    doc_num_sents = np.concatenate([res[3] for res in results])
+
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    with open(target_dir / 'lexicon.txt', 'w', encoding='utf8') as f:
+        f.write('\n'.join(lexicon))
+    np.save(target_dir / 'tokens.npy', tokens)
+    np.save(target_dir / 'sent_starts.npy',
+            np.concatenate([[0], np.cumsum(sent_lens)]))
+    np.save(target_dir / 'doc_sents.npy',
+            np.concatenate([[0], np.cumsum(doc_num_sents)]))
+    print(f'Saved {len(tokens)} tokens ({len(lexicon)} distinct) of '
+          f'{len(doc_num_sents)} docs to {target_dir}')
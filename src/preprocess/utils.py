@@ -1,11 +1,8 @@
 def split_tokens(raw_tokens: [str]) -> ([str], [str]):
     '''Return (tokens, pos_tags)'''
-    tokens, pos_tags = [], []
-    for t in raw_tokens:
-        sep = t.rindex('_')
-        token, pos_tag = t[:sep], t[sep + 1:]
-        tokens.append(token)
-        pos_tags.append(pos_tag)
+    pairs = [t.rsplit('_', 1) for t in raw_tokens]
+    tokens = [p[0] for p in pairs]
+    pos_tags = [p[1] for p in pairs]
     return tokens, pos_tags 
 
 
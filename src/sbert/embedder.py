@@ -9,7 +9,7 @@ import numpy as np
 
 from modeling import get_model
 
-sys.path.append('../preprocess')
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'preprocess'))
 from file_utils import jsonl_loader, save_jsonl, load_jsonl
 
 
@@ -57,34 +57,36 @@ def embed_sentences(sentences) -> list:
     return all_embeds
 
 
+def gen_text_docs(docs_file: Path, text_docs_file: Path) -> None:
+    '''Turn docs into text docs (see `preprocess_data`), takes ~1 min.'''
+    text_docs = preprocess_data(jsonl_loader(docs_file))
+    print(f'Saving preprocessed {len(text_docs)} documents to {text_docs_file}')
+    save_jsonl(text_docs, text_docs_file)
+
+
+def gen_embeddings(text_docs_file: Path, embeddings_file: Path) -> None:
+    '''Embed all text docs, takes ~4h on GPU.'''
+    # SentenceTransformer accepts a list of sentences (strings).
+    # We just pass the document text as sentences.
+    text_docs = [d['content'] for d in jsonl_loader(text_docs_file)]
+    embeds = np.array(embed_sentences(text_docs))
+    with open(embeddings_file, 'wb') as f:
+        pkl.dump(embeds, f)
+    print(f'Saved embeddings to {embeddings_file}')
+
+
 def get_embeds(data_dir):
     docs_file = data_dir / 'docs.jsonl'
     text_docs_file = data_dir / 'text_docs.jsonl'
     embeddings_file = data_dir / 'embeddings.pkl'
 
-    if embeddings_file.exists():
-        print(f'{embeddings_file} already exists, loading...')
-        embeds = pkl.load(open(embeddings_file, 'rb'))
-    else:
+    if not embeddings_file.exists():
         # Preprocess tokens to natural text for SentenceBERT
-        if text_docs_file.exists():
-            print(f'Loading preprocessed data from {text_docs_file}')
-            text_docs = jsonl_loader(text_docs_file)
-        else:
-            doc_loader = jsonl_loader(docs_file)
-            # Turn into text docs, takes ~1 min.
-            text_docs = preprocess_data(doc_loader)
-            print(f'Saving preprocessed {len(text_docs)} documents to {text_docs_file}')
-            save_jsonl(text_docs, text_docs_file)
-        
-        # Embed documents, takes ~4h on GPU.
-        # SentenceTransformer accepts a list of sentences (strings).
-        # We just pass the document text as sentences.
-        text_docs = [d['content'] for d in text_docs]
-        embeds = embed_sentences(text_docs)
-        with open(output_file, 'wb') as f:
-            pkl.dump(embeds, f)
-        print(f'Saved embeddings to {output_file}')
+        if not text_docs_file.exists():
+            gen_text_docs(docs_file, text_docs_file)
+        gen_embeddings(text_docs_file, embeddings_file)
+    print(f'Loading {embeddings_file}...')
+    embeds = pkl.load(open(embeddings_file, 'rb'))
     return embeds
 
 
@@ -115,6 +117,14 @@ def get_sim_docs(embeds, output_dir, topk=100, chunk_size=2**12):
     return sim_docs
 
 
+def gen_sim_docs(embeddings_file: Path, output_dir: Path, topk=100,
+                 chunk_size=2**12) -> None:
+    '''Get most similar documents for each document, see `get_sim_docs`.'''
+    embeds = pkl.load(open(embeddings_file, 'rb'))
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    get_sim_docs(embeds, Path(output_dir), topk, chunk_size)
+
+
 def main():
     data_dir = Path('../../data')
     embeds = get_embeds(data_dir)
@@ -5,7 +5,7 @@ A file a random sampling documents for analysis of LSI result.
 import pickle as pkl
 
 from preprocess.file_utils import load_jsonl
-from backend.utils import process_boolean_query
+from backend.utils import process_boolean_queries
 import random
 
 
@@ -25,9 +25,10 @@ queries = [
 
 final_doc_ids = []
 
-for query in queries:
+# Evaluate all queries at once, they share terms and sub-expressions.
+results = process_boolean_queries(queries, inv_idx, len(docs))
+for query, doc_ids in zip(queries, results):
     print('Processing query:', query)
-    doc_ids = process_boolean_query(query, inv_idx, len(docs))
     doc_ids = [doc_id for doc_id in doc_ids if doc_id in doc_ids_small]
     print('Found {} docs'.format(len(doc_ids)))
     sampled_doc_ids = random.sample(doc_ids, 4)
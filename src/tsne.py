@@ -1,7 +1,7 @@
 import pickle as pkl
 import scipy as sp
 import numpy as np
-from lsi.lsi import lsi
+from lsi.lsi import lsi, truncate
 from sklearn.manifold import TSNE
 # from yellowbrick.text import TSNEVisualizer
 
@@ -145,9 +145,11 @@ def plot_similarity_matrices(vocab: list, terms: list, docs: list,
     '''
     Plot the similarity matrices of terms and documents.
     '''
-    
-    for n_components in [10, 20, 50, 100, 200, 300, 400, 500, 600]:
-        U, sigma, V = lsi(tfidf, n_components) 
+    list_k = [10, 20, 50, 100, 200, 300, 400, 500, 600]
+    # Fit once with the largest k, every smaller k is a truncation of it.
+    lsi_result = lsi(tfidf, max(list_k))
+    for n_components in list_k:
+        U, sigma, V = truncate(*lsi_result, n_components)
         plot_similarity_of_terms(terms, vocab, U)
         plot_similarity_of_docs(docs, V)
 